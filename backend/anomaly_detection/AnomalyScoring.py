@@ -1,68 +1,236 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
-from aeon.anomaly_detection import MERLIN, STOMP, DWT_MLEAD, KMeansAD, LOF
+import pymongo
+from aeon.anomaly_detection import MERLIN, STOMP, DWT_MLEAD, KMeansAD
 from bson import ObjectId
 from pymongo.synchronous.database import Database
 from tslearn.preprocessing import TimeSeriesResampler
 import backend.helper.database as database
+import backend.helper.lod as lod
+import backend.helper.score_store as score_store
+from backend.anomaly_detection.MatrixProfile import IncrementalMatrixProfile, profile_path
+from backend.anomaly_detection.WindowedLOF import WindowedLOF
+from backend.helper.config import get_config
+
+conf = get_config()
+# detectors whose score of a point only depends on a bounded neighbourhood, these can score appended data on their own
+STREAMING_METHODS = ["STOMP", "KMeansAD", "LOF", "DWT_MLEAD"]
+# detectors whose fitted state transfers between similar series, these can share one model per bucket and channel
+SHARED_MODEL_METHODS = ["KMeansAD", "LOF"]
+DETECTORS = {
+    "MERLIN": MERLIN,
+    "STOMP": STOMP,
+    "DWT_MLEAD": DWT_MLEAD,
+    "KMeansAD": KMeansAD,
+    "LOF": WindowedLOF,
+}
+# shared models loaded by this process, keyed by their file path
+shared_models = {}
 
 
 def smooth_merlin(scores, window_size):
-    new_scores = []
-    for idx, s in enumerate(scores):
-        subset = scores[max(0, idx - window_size // 2):idx + window_size // 2]
-        if np.any(subset):
-            new_scores.append(1)
-        else:
-            new_scores.append(0)
-    return new_scores
+    # a point becomes 1 if any score in [idx - window_size // 2, idx + window_size // 2) is set
+    nonzero = np.asarray(scores) != 0
+    counts = np.concatenate([[0], np.cumsum(nonzero)])
+    idx = np.arange(len(nonzero))
+    start = np.maximum(0, idx - window_size // 2)
+    end = np.minimum(len(nonzero), idx + window_size // 2)
+    return (counts[end] - counts[start] > 0).astype(int)
 
 
 class AnomalyScoring:
     def __init__(self, parameters: dict, method: str):
+        if method not in DETECTORS:
+            raise Exception("Unknown algorithm")
         self.method = method
         self.parameters = parameters
+        self.detector = DETECTORS[method]
 
-    def anomaly_detection(self, values: np.ndarray):
-        if self.method == "MERLIN":
-            detector = MERLIN(**self.parameters)
-        elif self.method == "STOMP":
-            detector = STOMP(**self.parameters)
-        elif self.method == "DWT_MLEAD":
-            detector = DWT_MLEAD(**self.parameters)
-        elif self.method == "KMeansAD":
-            detector = KMeansAD(**self.parameters)
-        elif self.method == "LOF":
-            detector = LOF(**self.parameters)
-        else:
-            raise Exception("Unknown algorithm")
+    def fit(self, values: np.ndarray):
+        return self.detector(**self.parameters).fit(values)
+
+    def anomaly_detection(self, values: np.ndarray, model=None):
         original_length = len(values)
-        if self.method == "LOF":
-            values = TimeSeriesResampler(1000).fit_transform(values).flatten()
-        scores = detector.fit_predict(values)
-        scores = np.array([float(s) for s in scores])
+        if model is not None:
+            scores = model.predict(values)
+        else:
+            scores = self.detector(**self.parameters).fit_predict(values)
+        scores = np.asarray(scores, dtype=np.float64)
         if self.method == "MERLIN":
             scores = smooth_merlin(scores, 20)
         return TimeSeriesResampler(original_length).fit_transform(scores).flatten()
 
 
-def score_timeseries(db: Database, TID: ObjectId, parameters, method, algo_id: ObjectId):
+def shared_model_path(BID: ObjectId, algo_id: ObjectId, channel: str, config_fingerprint: str):
+    channel_hash = hashlib.sha1(channel.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(Path(__file__).parent, "models", str(BID),
+                        f"shared_{algo_id}_{channel_hash}_{config_fingerprint[:12]}.pkl")
+
+
+def fit_shared_model(db: Database, BID: ObjectId, parameters, method, algo_id: ObjectId, channel: str):
+    path = shared_model_path(BID, algo_id, channel, database.get_config_fingerprint(method, parameters, True))
+    if os.path.exists(path):
+        return False
+    # the model is fitted on the most recent points of a random sample of the bucket's series
+    sample = conf["shared_models"]
+    sampled_ts = db["timeSeries"].aggregate(
+        [{"$match": {"BID": BID, "channels": channel}}, {"$sample": {"size": sample["series"]}}])
+    values = [
+        database.read_timeseries_columns(db, ts["_id"], [channel], direction=pymongo.DESCENDING,
+                                         limit=sample["points"])[1][channel]
+        for ts in sampled_ts
+    ]
+    values = [v for v in values if len(v) > 0]
+    if len(values) == 0:
+        return False
+    model = AnomalyScoring(parameters, method).fit(np.concatenate(values))
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    # schedulers share the models directory and may fit the same model at once, each writes its own temporary file
+    fd, tmp_path = tempfile.mkstemp(dir=Path(path).parent, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(model, f)
+    os.replace(tmp_path, path)
+    return True
+
+
+def uses_shared_model(BID: ObjectId, parameters, method, algo_id: ObjectId, channel: str, shared_model: bool):
+    # without a fitted model, e.g. as the channel had no points to sample, the series is fitted on its own
+    return shared_model and method in SHARED_MODEL_METHODS and os.path.exists(
+        shared_model_path(BID, algo_id, channel, database.get_config_fingerprint(method, parameters, True)))
+
+
+def load_shared_model(BID: ObjectId, parameters, method, algo_id: ObjectId, channel: str):
+    path = shared_model_path(BID, algo_id, channel, database.get_config_fingerprint(method, parameters, True))
+    if path not in shared_models:
+        with open(path, "rb") as f:
+            shared_models[path] = pickle.load(f)
+    return shared_models[path]
+
+
+def store_scores(db: Database, BID: ObjectId, TID: ObjectId, algo_id: ObjectId, channel: str, timestamps: list,
+                 scores: np.ndarray, after=None):
+    # replaces all scores, or only those after a timestamp, and keeps the baseline and the score pyramid in sync
+    deleted = score_store.delete_scores(db, TID, algo_id, channel, after=after)
+    # stats and pyramid are computed from the scores in the precision they are stored in
+    scores = score_store.write_scores(db, BID, TID, algo_id, channel, timestamps, scores)
+    if len(scores) > 0 and after is None:
+        database.set_score_stats(db, BID, TID, algo_id, channel, float(np.min(scores)), float(np.max(scores)))
+    elif len(scores) > 0 and deleted == 0:
+        database.extend_score_stats(db, BID, TID, algo_id, channel, float(np.min(scores)), float(np.max(scores)))
+    else:
+        # part of the old scores was dropped, their extremes may be gone
+        database.refresh_score_stats(db, BID, TID, algo_id, channel)
+    if after is None:
+        lod.build_pyramid(db, BID, TID, channel, algo_id, timestamps, scores)
+    elif not lod.extend_pyramid(db, BID, TID, channel, algo_id, timestamps, scores):
+        stored_timestamps, stored_scores = score_store.read_scores(db, BID, TID, algo_id, channel)
+        lod.build_pyramid(db, BID, TID, channel, algo_id, stored_timestamps, stored_scores)
+
+
+def score_timeseries(db: Database, TID: ObjectId, parameters, method, algo_id: ObjectId, channels: list = None,
+                     shared_model: bool = False):
+    ts = database.get_timeseries(db, TID)
+    shared = {channel: uses_shared_model(ts["BID"], parameters, method, algo_id, channel, shared_model)
+              for channel in ts["channels"]}
+    data_fingerprint = database.get_data_fingerprint(db, TID)
+    config_fingerprints = {channel: database.get_config_fingerprint(method, parameters, shared[channel])
+                           for channel in ts["channels"]}
+    channels = [
+        channel for channel in ts["channels"]
+        if (channels is None or channel in channels) and not database.score_fingerprint_matches(
+            db, TID, algo_id, channel, data_fingerprint, config_fingerprints[channel])
+    ]
+    if len(channels) == 0:
+        return False
     algo = AnomalyScoring(parameters, method)
+    timestamps, columns = database.read_timeseries_columns(db, TID, channels)
+    for channel in channels:
+        if method == "STOMP":
+            # keep the matrix profile around so appended points can extend it instead of recomputing it
+            profile = IncrementalMatrixProfile(columns[channel], parameters["window_size"])
+            profile.save(profile_path(ts["BID"], TID, channel, algo_id))
+            scores = profile.point_scores()
+        else:
+            model = load_shared_model(ts["BID"], parameters, method, algo_id, channel) if shared[channel] else None
+            scores = algo.anomaly_detection(columns[channel], model)
+        store_scores(db, ts["BID"], TID, algo_id, channel, timestamps, scores)
+        pyramid = lod.get_pyramid(db, TID, channel)
+        if pyramid is None or pyramid["rows"] != len(timestamps):
+            lod.build_pyramid(db, ts["BID"], TID, channel, None, timestamps, columns[channel])
+        database.set_score_fingerprint(db, ts["BID"], TID, algo_id, channel, data_fingerprint,
+                                       config_fingerprints[channel])
+    return True
+
+
+def tail_context_length(parameters: dict):
+    streaming = conf["streaming"]
+    return max(streaming["min_context"], streaming["context_windows"] * parameters.get("window_size", 0))
+
+
+def score_timeseries_tail(db: Database, TID: ObjectId, parameters, method, algo_id: ObjectId, channels: list = None,
+                          shared_model: bool = False):
     ts = database.get_timeseries(db, TID)
-    data_points = list(db["timeSeriesData"].find({"ids.TID": TID}))
-    for channel in ts["channels"]:
-        values = np.array([item["values"][channel] for item in data_points])
-        scores = algo.anomaly_detection(values)
-        scores_to_insert = [
-            {
-                "timestamp": data_points[index]["timestamp"],
-                "value": s,
-                "ids": {"BID": ts["BID"], "TID": TID, "AlgoID": algo_id},
-                "channel": channel
-            } for index, s in enumerate(scores)
-        ]
-        db["anomalyScores"].delete_many({"ids.AlgoID": algo_id, "ids.TID": TID})
-        db["anomalyScores"].insert_many(scores_to_insert)
+    data_fingerprint = database.get_data_fingerprint(db, TID)
+    channels = [channel for channel in ts["channels"] if channels is None or channel in channels]
+    shared = {channel: uses_shared_model(ts["BID"], parameters, method, algo_id, channel, shared_model)
+              for channel in channels}
+    config_fingerprints = {channel: database.get_config_fingerprint(method, parameters, shared[channel])
+                           for channel in channels}
+    fingerprints = [database.get_score_fingerprint(db, TID, algo_id, channel) for channel in channels]
+    # without scores for the old data of this exact configuration there is nothing to append to
+    if method not in STREAMING_METHODS or any(f is None or f["config"] != config_fingerprints[channel]
+                                              for f, channel in zip(fingerprints, channels)):
+        return score_timeseries(db, TID, parameters, method, algo_id, channels, shared_model)
+    if all(f["data"] == data_fingerprint for f in fingerprints):
+        return False
+    # everything after the oldest end of the stored scores is new, even if an earlier append has not been scored yet
+    scored_until = min(f["data"]["last_timestamp"] for f in fingerprints)
+    tail_timestamps, tail = database.read_timeseries_columns(db, TID, channels, {"timestamp": {"$gt": scored_until}})
+    if len(tail_timestamps) == 0:
+        return False
+    if method == "STOMP":
+        return extend_stomp_scores(db, ts, TID, parameters, algo_id, channels, scored_until, tail_timestamps, tail,
+                                   data_fingerprint, database.get_config_fingerprint(method, parameters))
+    _, context = database.read_timeseries_columns(db, TID, channels, {"timestamp": {"$lte": scored_until}},
+                                                  pymongo.DESCENDING, tail_context_length(parameters))
+    algo = AnomalyScoring(parameters, method)
+    for channel in channels:
+        values = np.concatenate([context[channel], tail[channel]])
+        model = load_shared_model(ts["BID"], parameters, method, algo_id, channel) if shared[channel] else None
+        scores = algo.anomaly_detection(values, model)[len(context[channel]):]
+        store_scores(db, ts["BID"], TID, algo_id, channel, tail_timestamps, scores, after=scored_until)
+        database.set_score_fingerprint(db, ts["BID"], TID, algo_id, channel, data_fingerprint,
+                                       config_fingerprints[channel])
+    return True
+
+
+def extend_stomp_scores(db: Database, ts: dict, TID: ObjectId, parameters, algo_id: ObjectId, channels: list,
+                        scored_until, tail_timestamps: list, tail: dict, data_fingerprint: dict,
+                        config_fingerprint: str):
+    window_size = parameters["window_size"]
+    scored_length = db["timeSeriesData"].count_documents({"ids.TID": TID, "timestamp": {"$lte": scored_until}})
+    history = None
+    for channel in channels:
+        path = profile_path(ts["BID"], TID, channel, algo_id)
+        profile = IncrementalMatrixProfile.load(path, window_size, scored_length)
+        if profile is None:
+            # no usable stored profile, rebuild it once from the points that are already scored
+            if history is None:
+                _, history = database.read_timeseries_columns(db, TID, channels, {"timestamp": {"$lte": scored_until}})
+            profile = IncrementalMatrixProfile(history[channel], window_size)
+        profile.update(tail[channel])
+        profile.save(path)
+        scores = profile.point_scores()[-len(tail_timestamps):]
+        store_scores(db, ts["BID"], TID, algo_id, channel, tail_timestamps, scores, after=scored_until)
+        database.set_score_fingerprint(db, ts["BID"], TID, algo_id, channel, data_fingerprint, config_fingerprint)
+    return True
 
 
 def example9():
@@ -72,6 +240,29 @@ def example9():
     print(scores)
 
 
+def benchmark_smooth_merlin():
+    def smooth_merlin_loop(scores, window_size):
+        new_scores = []
+        for idx, s in enumerate(scores):
+            subset = scores[max(0, idx - window_size // 2):idx + window_size // 2]
+            if np.any(subset):
+                new_scores.append(1)
+            else:
+                new_scores.append(0)
+        return new_scores
+
+    scores = np.zeros(1_000_000)
+    scores[np.random.choice(len(scores), 2000, replace=False)] = 1
+    start = time.time()
+    expected = smooth_merlin_loop(scores, 20)
+    print(f"loop: {time.time() - start:.2f}s")
+    start = time.time()
+    result = smooth_merlin(scores, 20)
+    print(f"vectorized: {time.time() - start:.4f}s")
+    print("identical:", np.array_equal(expected, result))
+
+
 if __name__ == '__main__':
+    benchmark_smooth_merlin()
     example9()
     # example9()
@@ -10,7 +10,7 @@ from pymongo.synchronous.database import Database
 from PIL import Image
 
 import backend.helper.database as database
-from backend.helper.util import add_dbr_pca_to_segments
+from backend.helper.util import add_dbr_pca_to_segments, segments_cache_key
 from sklearn.neighbors import KernelDensity
 from scipy.ndimage import label
 
@@ -19,8 +19,9 @@ class KDE:
     def __init__(self, BID: ObjectId, channel: str, bandwidth: float, level: float = 1):
         self.db = database.get_db()
         self.level = level
+        key = segments_cache_key(self.db, BID, channel, 100, True)
         self.segments = database.get_all_bucket_segments(self.db, BID, channel, 100)
-        self.segments = add_dbr_pca_to_segments(BID, self.segments, True)
+        self.segments = add_dbr_pca_to_segments(BID, self.segments, key, True)
         self.points = np.array([[s["x"], s["y"]] for s in self.segments])
         self.kde = KernelDensity(kernel='gaussian', bandwidth=bandwidth)
         self.kde.fit(self.points)
@@ -5,14 +5,15 @@ from bson import ObjectId
 from pymongo.synchronous.database import Database
 
 import backend.helper.database as database
-from backend.helper.util import add_dbr_pca_to_segments
+from backend.helper.util import add_dbr_pca_to_segments, segments_cache_key
 
 
 class OCNN:
     def __init__(self, BID: ObjectId, channel: str, j: int, k: int, n_prototypes: int, ratio_threshold: float = 1):
         self.db = database.get_db()
+        key = segments_cache_key(self.db, BID, channel, 100, True)
         self.segments = database.get_all_bucket_segments(self.db, BID, channel, 100)
-        self.segments = add_dbr_pca_to_segments(BID, self.segments, True)
+        self.segments = add_dbr_pca_to_segments(BID, self.segments, key, True)
         self.j = j
         self.k = k
 
@@ -0,0 +1,105 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import stumpy
+from aeon.utils.windowing import reverse_windowing
+from bson import ObjectId
+
+
+def profile_path(BID: ObjectId, TID: ObjectId, channel: str, AlgoID: ObjectId):
+    channel_hash = hashlib.sha1(channel.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(Path(__file__).parent, "models", str(BID), f"stomp_{TID}_{AlgoID}_{channel_hash}.npz")
+
+
+def rolling_mean_std(T: np.ndarray, m: int):
+    # centering first keeps the cumulative sums small, otherwise the variance suffers from cancellation
+    centered = T - np.mean(T)
+    cumsum = np.concatenate([[0], np.cumsum(centered)])
+    cumsum_sq = np.concatenate([[0], np.cumsum(centered ** 2)])
+    mean = (cumsum[m:] - cumsum[:-m]) / m
+    var = (cumsum_sq[m:] - cumsum_sq[:-m]) / m - mean ** 2
+    return mean + np.mean(T), np.sqrt(np.clip(var, 0, None))
+
+
+def rolling_isconstant(T: np.ndarray, m: int):
+    # like stumpy, a window is constant if all of its values are equal, its std from the cumulative sums is not exact
+    changes = np.concatenate([[0], np.cumsum(np.diff(T) != 0)])
+    return changes[m - 1:] - changes[:len(changes) - m + 1] == 0
+
+
+def z_normalized_distance(QT: np.ndarray, mean: np.ndarray, std: np.ndarray, isconstant: np.ndarray, mean_q: float,
+                          std_q: float, isconstant_q: bool, m: int):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = (QT - m * mean * mean_q) / (m * std * std_q)
+    distance = np.sqrt(np.clip(2 * m * (1 - correlation), 0, None))
+    # constant windows have no shape, they only match other constant windows
+    constant = isconstant | isconstant_q
+    distance[constant] = np.where(isconstant[constant] & isconstant_q, 0, np.sqrt(m))
+    return distance
+
+
+class IncrementalMatrixProfile:
+    def __init__(self, T: np.ndarray, window_size: int, P: np.ndarray = None):
+        self.T = np.asarray(T, dtype=float)
+        self.m = window_size
+        self.exclusion_zone = int(np.ceil(self.m / stumpy.config.STUMPY_EXCL_ZONE_DENOM))
+        self.P = P if P is not None else stumpy.stump(self.T, self.m)[:, 0].astype(float)
+
+    def update(self, values: np.ndarray):
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        m = self.m
+        first_window = len(self.T) - m + 1
+        self.T = np.concatenate([self.T, values])
+        T = self.T
+        mean, std = rolling_mean_std(T, m)
+        isconstant = rolling_isconstant(T, m)
+        P = np.concatenate([self.P, np.full(len(T) - m + 1 - len(self.P), np.inf)])
+        # exact sliding dot products for the first new window, the following ones are derived in O(n) each (STAMPI)
+        QT = np.convolve(T, T[first_window:first_window + m][::-1], mode="valid")
+        for j in range(first_window, len(P)):
+            if j > first_window:
+                QT[1:j + 1] = QT[0:j] - T[0:j] * T[j - 1] + T[m:j + m] * T[j + m - 1]
+                QT[0] = np.dot(T[0:m], T[j:j + m])
+            distance = z_normalized_distance(QT[:j + 1], mean[:j + 1], std[:j + 1], isconstant[:j + 1], mean[j], std[j],
+                                             isconstant[j], m)
+            distance[max(0, j - self.exclusion_zone):j + 1] = np.inf
+            P[j] = np.min(distance)
+            P[:j] = np.minimum(P[:j], distance[:j])
+        self.P = P
+
+    def point_scores(self):
+        return reverse_windowing(self.P, self.m)
+
+    def save(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez(path, T=self.T, P=self.P, m=self.m)
+
+    @staticmethod
+    def load(path: str, window_size: int, length: int):
+        # a stored profile is only usable if it was built with this window over exactly the already scored points
+        if not os.path.exists(path):
+            return None
+        state = np.load(path)
+        if int(state["m"]) != window_size or len(state["T"]) != length:
+            return None
+        return IncrementalMatrixProfile(state["T"], window_size, state["P"])
+
+
+if __name__ == '__main__':
+    import time
+
+    series = np.sin(np.linspace(0, 200, 20000)) + np.random.normal(0, 0.1, 20000)
+    start = time.time()
+    full = stumpy.stump(series, 50)[:, 0].astype(float)
+    print(f"stump on {len(series)} points: {time.time() - start:.2f}s")
+    start = time.time()
+    profile = IncrementalMatrixProfile(series[:18000], 50)
+    print(f"stump on {18000} points: {time.time() - start:.2f}s")
+    start = time.time()
+    profile.update(series[18000:])
+    print(f"incremental update with {2000} points: {time.time() - start:.2f}s")
+    print("max deviation", np.max(np.abs(profile.P - full)))
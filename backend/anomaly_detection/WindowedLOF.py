@@ -0,0 +1,112 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    # the float32 variants of the trees keep half the memory, NearestNeighbors always converts its data to float64
+    from sklearn.neighbors._ball_tree import BallTree32 as BallTree
+    from sklearn.neighbors._kd_tree import KDTree32 as KDTree
+    TREE_DTYPE = np.float32
+except ImportError:
+    from sklearn.neighbors import BallTree, KDTree
+    TREE_DTYPE = np.float64
+TREES = {"ball_tree": BallTree, "kd_tree": KDTree}
+
+
+def reverse_windowing_mean(window_scores: np.ndarray, window_size: int):
+    # mean over all windows covering a point, same result as aeon's reverse_windowing with nanmean but in O(n) memory
+    n_windows = len(window_scores)
+    n = n_windows + window_size - 1
+    cumsum = np.concatenate([[0], np.cumsum(window_scores)])
+    points = np.arange(n)
+    first = np.maximum(0, points - window_size + 1)
+    last = np.minimum(points, n_windows - 1)
+    return (cumsum[last + 1] - cumsum[first]) / (last - first + 1)
+
+
+class WindowedLOF:
+    # local outlier factor over the sliding windows of a series, neighbours are queried in chunks against a tree.
+    # Memory grows linearly with the n windows of the fitted series: the tree keeps a float32 copy of them
+    # (n * window_size * 4 bytes) plus its index (n * 8 bytes), the neighbour tables take n * k * 8 bytes and the
+    # per window scores n * 8 bytes each. At 1M points, window_size 50 and k 20 that is about 200 + 8 + 160 + 24 MB,
+    # predict adds the tables of the predicted series.
+    def __init__(self, n_neighbors: int = 20, window_size: int = 10, algorithm: str = "ball_tree",
+                 chunk_size: int = 20000):
+        if algorithm not in TREES:
+            raise ValueError(f"algorithm must be one of {', '.join(TREES)}")
+        self.n_neighbors = n_neighbors
+        self.window_size = window_size
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+
+    def windows(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64).flatten()
+        if self.window_size < 1 or self.window_size > len(values):
+            raise ValueError("The window size must be at least 1 and at most the length of the time series.")
+        return sliding_window_view(values, self.window_size)
+
+    def neighbours(self, windows: np.ndarray, k: int, exclude_self: bool):
+        distances = np.empty((len(windows), k), dtype=np.float32)
+        indices = np.empty((len(windows), k), dtype=np.int32)
+        for start in range(0, len(windows), self.chunk_size):
+            # only the chunk is converted, the windows of a predicted series stay a view of the series
+            chunk = np.ascontiguousarray(windows[start:start + self.chunk_size], dtype=TREE_DTYPE)
+            if not exclude_self:
+                chunk_distances, chunk_indices = self.tree.query(chunk, k=k)
+            else:
+                # query one extra neighbour and drop the window itself, or the farthest one if a duplicate hid it
+                chunk_distances, chunk_indices = self.tree.query(chunk, k=k + 1)
+                own = chunk_indices == np.arange(start, start + len(chunk))[:, None]
+                own[~own.any(axis=1), -1] = True
+                chunk_distances = chunk_distances[~own].reshape(len(chunk), k)
+                chunk_indices = chunk_indices[~own].reshape(len(chunk), k)
+            distances[start:start + len(chunk)] = chunk_distances
+            indices[start:start + len(chunk)] = chunk_indices
+        return distances, indices
+
+    def local_reachability_density(self, distances: np.ndarray, indices: np.ndarray):
+        reach_distances = np.maximum(distances, self.k_distances_[indices])
+        return 1 / (np.mean(reach_distances, axis=1) + 1e-10)
+
+    def fit(self, values: np.ndarray):
+        # the one copy of the windows, the tree keeps it as its data
+        windows = np.ascontiguousarray(self.windows(values), dtype=TREE_DTYPE)
+        self.k = max(1, min(self.n_neighbors, len(windows) - 1))
+        self.tree = TREES[self.algorithm](windows)
+        distances, indices = self.neighbours(windows, self.k, exclude_self=True)
+        self.k_distances_ = distances[:, -1]
+        self.lrd_ = self.local_reachability_density(distances, indices)
+        self.window_scores_ = np.mean(self.lrd_[indices], axis=1) / self.lrd_
+        return self
+
+    def predict(self, values: np.ndarray):
+        # scores a series against the windows seen in fit, like LOF with novelty=True
+        distances, indices = self.neighbours(self.windows(values), self.k, exclude_self=False)
+        lrd = self.local_reachability_density(distances, indices)
+        return reverse_windowing_mean(np.mean(self.lrd_[indices], axis=1) / lrd, self.window_size)
+
+    def fit_predict(self, values: np.ndarray):
+        self.fit(values)
+        return reverse_windowing_mean(self.window_scores_, self.window_size)
+
+
+if __name__ == '__main__':
+    import time
+    import tracemalloc
+    from aeon.anomaly_detection import LOF
+    from tslearn.preprocessing import TimeSeriesResampler
+
+    for length in [10000, 100000, 1000000]:
+        series = np.sin(np.linspace(0, length / 50, length)) + np.random.normal(0, 0.05, length)
+        series[length // 2:length // 2 + 100] += 1
+        start = time.time()
+        resampled = TimeSeriesResampler(1000).fit_transform(series).flatten()
+        scores = LOF(n_neighbors=20, window_size=50).fit_predict(resampled)
+        scores = TimeSeriesResampler(length).fit_transform(scores).flatten()
+        print(f"{length} points, resampled aeon LOF: {time.time() - start:.2f}s")
+        tracemalloc.start()
+        start = time.time()
+        scores = WindowedLOF(n_neighbors=20, window_size=50).fit_predict(series)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{length} points, windowed LOF: {time.time() - start:.2f}s, peak memory {peak / 2 ** 20:.0f} MiB, "
+              f"top score at {np.argmax(scores)}")
@@ -1,7 +1,10 @@
 import json
+import multiprocessing
 import os
 import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 
 import redis
@@ -11,14 +14,18 @@ from pymongo.database import Database
 import backend.anomaly_detection.Classification.KDE as KDE
 import backend.anomaly_detection.Classification.OCNN as OCNN
 import backend.helper.database as database
-from backend.anomaly_detection.AnomalyScoring import score_timeseries
+import backend.helper.scheduler_queue as scheduler_queue
+from backend.anomaly_detection.AnomalyScoring import score_timeseries, score_timeseries_tail, fit_shared_model, \
+    SHARED_MODEL_METHODS
 from backend.helper.config import get_config, get_redis_keys
 
 conf = get_config()
 redis_keys = get_redis_keys()
 ANOMALY_CALC_QUEUE = redis_keys["ANOMALY_CALC_QUEUE"]
-ANOMALY_CALC_STATUS = redis_keys["ANOMALY_CALC_STATUS"]
 ANOMALY_CALC_ERRORED = redis_keys["ANOMALY_CALC_ERRORED"]
+# seconds to wait after the scheduler loop failed, doubled up to the maximum while it keeps failing
+RETRY_BACKOFF_MIN = 1
+RETRY_BACKOFF_MAX = 60
 os.chdir(os.path.abspath(os.path.dirname(__file__)))
 log_file_global = open(conf["scheduler"]["logfile"], "a")
 
@@ -29,11 +36,11 @@ def log(log_file, type_, message):
         log_file.flush()
     print(f"[{timestamp}] [{type_}] {message}")
 
-def processClassificationBucket(BID: ObjectId, r: redis.Redis, db: Database):
-    algorithms = database.get_bucket_algorithms(db, BID)
-    channels = database.bucket_channels(db, BID)
-    status = {"message": "preparing", "current": 0, "total": channels * len(algorithms)}
-    r_key = f"{ANOMALY_CALC_STATUS}:{str(BID)}"
+def processClassificationBucket(BID: ObjectId, r: redis.Redis, db: Database, r_key: str, AlgoID: ObjectId = None,
+                                channel: str = None):
+    algorithms = [a for a in database.get_bucket_algorithms(db, BID) if AlgoID is None or a["_id"] == AlgoID]
+    channels = [c for c in database.bucket_channels(db, BID) if channel is None or c == channel]
+    status = {"message": "preparing", "current": 0, "total": len(channels) * len(algorithms)}
     r.set(r_key, json.dumps(status))
     for channel in channels:
         for algo in algorithms:
@@ -53,63 +60,171 @@ def processClassificationBucket(BID: ObjectId, r: redis.Redis, db: Database):
     r.set(r_key, json.dumps(status))
     log(log_file_global, f"CLASSIFICATION", f"{str(BID)} - DONE")
 
-def processScoringBucket(BID: ObjectId, r: redis.Redis, db: Database):
-    algorithms = database.get_bucket_algorithms(db, BID)
-    ts_list = database.list_timeseries(db, BID)
-    status = {"message": "preparing", "current": 0, "total": len(ts_list) * len(algorithms)}
-    r_key = f"{ANOMALY_CALC_STATUS}:{str(BID)}"
-    r.set(r_key, json.dumps(status))
+worker_db: Database | None = None
+
+def init_scoring_worker():
+    # every worker process connects on its own, a MongoClient cannot be passed to another process
+    global worker_db
+    worker_db = database.get_db()
+
+def create_scoring_pool():
+    # the scheduler runs threads and holds a MongoClient, forking it could copy a lock some thread holds
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=conf["scheduler"]["workers"] or os.cpu_count(),
+                               mp_context=multiprocessing.get_context(start_method), initializer=init_scoring_worker)
+
+def score_timeseries_job(TID: ObjectId, algorithm_config: dict, method: str, algo_id: ObjectId, channels: list = None,
+                         append: bool = False, shared_model: bool = False):
+    with database.metadata_scope():
+        if append:
+            return score_timeseries_tail(worker_db, TID, algorithm_config, method, algo_id, channels, shared_model)
+        return score_timeseries(worker_db, TID, algorithm_config, method, algo_id, channels, shared_model)
 
+def processScoringBucket(BID: ObjectId, r: redis.Redis, db: Database, r_key: str, pool: ProcessPoolExecutor,
+                         TID: ObjectId = None, AlgoID: ObjectId = None, channel: str = None, append: bool = False):
+    algorithms = [a for a in database.get_bucket_algorithms(db, BID) if AlgoID is None or a["_id"] == AlgoID]
+    ts_list = [ts for ts in database.list_timeseries(db, BID) if TID is None or ts["_id"] == TID]
+    channels = [channel] if channel is not None else None
+    jobs = []
     for algo in algorithms:
-        algorithm_config = {k: algo["parameters"][k]["value"] for k in algo["parameters"]}
         if algo["type"] != "scoring":
             continue
+        algorithm_config = {k: algo["parameters"][k]["value"] for k in algo["parameters"]}
         for ts in ts_list:
-            log(log_file_global, f"SCORING", f"{ts['name']} - {algo['name']}")
-            status["message"] = f"{ts['name']} {algo['name']}"
-            r.set(r_key, json.dumps(status))
-            score_timeseries(db, ts["_id"], algorithm_config, algo["algorithm"], algo["_id"])
-            status["current"] += 1
-            r.set(r_key, json.dumps(status))
+            jobs.append((ts, algo, algorithm_config))
+    status = {"message": "preparing", "current": 0, "total": len(jobs), "computed": 0, "skipped": 0}
+    r.set(r_key, json.dumps(status))
+
+    shared_model = database.get_bucket(db, BID).get("shared_model", False)
+    if shared_model:
+        # fit the shared models up front, the workers then only run predict with them
+        shared_channels = [c for c in database.bucket_channels(db, BID) if channel is None or c == channel]
+        for algo in algorithms:
+            if algo["type"] != "scoring" or algo["algorithm"] not in SHARED_MODEL_METHODS:
+                continue
+            algorithm_config = {k: algo["parameters"][k]["value"] for k in algo["parameters"]}
+            for bucket_channel in shared_channels:
+                status["message"] = f"Fitting shared model {bucket_channel} {algo['name']}"
+                r.set(r_key, json.dumps(status))
+                if fit_shared_model(db, BID, algorithm_config, algo["algorithm"], algo["_id"], bucket_channel):
+                    log(log_file_global, f"SCORING", f"{str(BID)} - shared model {bucket_channel} {algo['name']}")
+
+    futures = {
+        pool.submit(score_timeseries_job, ts["_id"], algorithm_config, algo["algorithm"], algo["_id"], channels,
+                    append, shared_model): (ts, algo)
+        for ts, algo, algorithm_config in jobs
+    }
+    # only this process writes the status key, so the progress counter cannot race between workers
+    for future in as_completed(futures):
+        ts, algo = futures[future]
+        try:
+            computed = future.result()
+        except Exception:
+            # the pool outlives the task, only the jobs of this task are dropped
+            for pending in futures:
+                pending.cancel()
+            raise
+        status["computed" if computed else "skipped"] += 1
+        log(log_file_global, f"SCORING", f"{ts['name']} - {algo['name']}")
+        status["message"] = f"{ts['name']} {algo['name']}"
+        status["current"] += 1
+        r.set(r_key, json.dumps(status))
     status["message"] = f"Done"
     r.set(r_key, json.dumps(status))
     log(log_file_global, f"SCORING", f"{str(BID)} - DONE")
 
 # ----------------------------------------------------------------------------------------------------------------------
+class HeartbeatSender(threading.Thread):
+    def __init__(self, redis_instance: redis.Redis, worker_id: str):
+        threading.Thread.__init__(self, daemon=True)
+        self.redis = redis_instance
+        self.worker_id = worker_id
+
+    def run(self):
+        while True:
+            try:
+                scheduler_queue.send_heartbeat(self.redis, self.worker_id, conf["scheduler"]["heartbeat_timeout"])
+                time.sleep(conf["scheduler"]["heartbeat_interval"])
+            except Exception as e:
+                # the heartbeat must outlive a lost connection, otherwise the running task is handed to another worker
+                log(log_file_global, "HEARTBEAT", f"Sending the heartbeat failed, retrying in {RETRY_BACKOFF_MIN}s: "
+                                                  f"{e}")
+                time.sleep(RETRY_BACKOFF_MIN)
+
+
 class AnomalyCalculatorScheduler(threading.Thread):
     def __init__(self, redis_instance: redis.Redis, db: Database):
         threading.Thread.__init__(self)
         self.redis = redis_instance
         self.db = db
-        self.redis.delete(ANOMALY_CALC_QUEUE)
-        for key in r.scan_iter(f"{ANOMALY_CALC_STATUS}:*"):
-            r.delete(key)
-        for key in r.scan_iter(f"{ANOMALY_CALC_ERRORED}:*"):
-            r.delete(key)
-        log(log_file_global, "ANOMALY SCHEDULER", "Initialized")
+        self.worker_id = scheduler_queue.get_worker_id()
+        self.heartbeat = HeartbeatSender(self.redis, self.worker_id)
+        # worker processes are started once and reused by all scoring tasks of this scheduler
+        self.pool = create_scoring_pool()
+        # item and status key of a task whose end could not be recorded yet
+        self.unfinished = None
+        # a restarted container can come back with the same worker id, take back what the old process left behind
+        for item in scheduler_queue.requeue_worker_items(self.redis, self.worker_id):
+            log(log_file_global, "ANOMALY SCHEDULER", f"Re-queued unfinished task {item}")
+        scheduler_queue.clear_worker_statuses(self.redis, self.worker_id)
+        log(log_file_global, "ANOMALY SCHEDULER", f"Initialized worker {self.worker_id}")
 
     def run(self):
+        self.heartbeat.start()
+        backoff = RETRY_BACKOFF_MIN
         while True:
-            # Check if the queue is empty
-            if not self.redis.lrange(ANOMALY_CALC_QUEUE, 0, 0):
-                time.sleep(0.5)
-                continue
-            item = self.redis.lpop(ANOMALY_CALC_QUEUE)
-            if item is None:
-                continue
-            bid = item.decode('utf-8')
-            self.redis.lrem(ANOMALY_CALC_QUEUE, 0, bid)
-            log(log_file_global, f"SCHEDULER", f"Handling anomaly calculation for bucket {bid}")
-            bucket = database.get_bucket(self.db, ObjectId(bid))
             try:
+                self.handle_next_item()
+                backoff = RETRY_BACKOFF_MIN
+            except Exception as e:
+                # e.g. Redis being unreachable, the worker continues claiming work once it is back
+                log(log_file_global, "SCHEDULER", f"Scheduler loop failed, retrying in {backoff}s: {e}")
+                time.sleep(backoff)
+                backoff = min(2 * backoff, RETRY_BACKOFF_MAX)
+
+    def finish(self):
+        item, r_key = self.unfinished
+        status = self.redis.get(r_key)
+        if status is None or json.loads(status)["message"] not in scheduler_queue.FINISHED_STATUS:
+            status = {"message": "error", "current": 0, "total": 0, "error": "Interrupted by a scheduler error"}
+            self.redis.set(r_key, json.dumps(status))
+        scheduler_queue.acknowledge_item(self.redis, self.worker_id, item)
+        self.unfinished = None
+
+    def handle_next_item(self):
+        if self.unfinished is not None:
+            self.finish()
+        for item in scheduler_queue.requeue_orphaned_items(self.redis):
+            log(log_file_global, f"SCHEDULER", f"Re-queued task {item} of a dead worker")
+        item = scheduler_queue.claim_item(self.redis, self.worker_id, conf["scheduler"]["heartbeat_interval"])
+        if item is None:
+            return
+        self.redis.lrem(ANOMALY_CALC_QUEUE, 0, item)
+        task = scheduler_queue.decode_task(item)
+        bid = task["BID"]
+        TID = ObjectId(task["TID"]) if task["TID"] is not None else None
+        AlgoID = ObjectId(task["AlgoID"]) if task["AlgoID"] is not None else None
+        log(log_file_global, f"SCHEDULER", f"Handling anomaly calculation for task {item}")
+        r_key = scheduler_queue.task_status_key(item, self.worker_id)
+        self.unfinished = (item, r_key)
+        try:
+            with database.metadata_scope():
+                bucket = database.get_bucket(self.db, ObjectId(bid))
                 if bucket["type"] == "scoring":
-                    processScoringBucket(ObjectId(bid), self.redis, self.db)
+                    processScoringBucket(ObjectId(bid), self.redis, self.db, r_key, self.pool, TID, AlgoID,
+                                         task["channel"], task["append"])
                 else:
-                    processClassificationBucket(ObjectId(bid), self.redis, self.db)
-            except Exception as e:
-                status = {"message": "error", "current": 0, "total": 0, "error": str(e)}
-                r_key = f"{ANOMALY_CALC_STATUS}:{bid}"
-                r.set(r_key, json.dumps(status))
+                    # classification works on all segments of a bucket, hence only algorithm and channel narrow it
+                    # down
+                    processClassificationBucket(ObjectId(bid), self.redis, self.db, r_key, AlgoID, task["channel"])
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                # a worker process died, e.g. killed for its memory, the pool cannot take any further jobs
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = create_scoring_pool()
+            status = {"message": "error", "current": 0, "total": 0, "error": str(e)}
+            self.redis.set(r_key, json.dumps(status))
+        self.finish()
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -1,6 +1,11 @@
+import glob
+import hashlib
 import json
 import os
 import pickle
+import tempfile
+import time
+from pathlib import Path
 
 import numpy as np
 import redis
@@ -14,44 +19,200 @@ if os.environ.get('DOCKER', "False") == 'True':
 r = redis.Redis(host=redis_host, port=conf["scheduler"]["redis"]["port"], db=1)
 
 CACHE_CLUSTERING = conf["cache"]["keys"]["CLUSTERING"]
-CACHE_DTW = conf["cache"]["keys"]["DTW"]
+CACHE_BASELINE_MIN_MAX = conf["cache"]["keys"]["BASELINE_MIN_MAX"]
+CACHE_VERSION = conf["cache"]["keys"]["VERSION"]
+CACHE_METRICS = conf["cache"]["keys"]["METRICS"]
+# entries unused for this many seconds expire, distance files are additionally evicted least recently used first
+# when they exceed the budget
+CACHE_TTL = conf["cache"]["ttl"]
+DISTANCE_BUDGET = conf["cache"]["distance_budget_mb"] * 2 ** 20
+# distance matrices are float32 .npy files next to the bucket's models, readers memory-map them and only touch the
+# rows they use. They are removed together with the models when the bucket is deleted.
+DISTANCE_DIR = os.path.join(Path(__file__).parents[1], "anomaly_detection", "models")
+
+
+def data_version(BID: str):
+    if r is not None:
+        return int(r.get(f"{CACHE_VERSION}:{str(BID)}") or 0)
+    return 0
+
+
+def cache_key(BID: str, kind: str, channel: str = None, granularity: str = None):
+    # the data version of the bucket is part of every key, it has to be taken before the data is read so that results
+    # computed from data that changed meanwhile are stored under an outdated key and never served
+    return f"{str(BID)}:{kind}:{channel}:{granularity}:v{data_version(BID)}"
+
+
+def record_access(cache: str, hit: bool):
+    if r is not None:
+        r.hincrby(CACHE_METRICS, f"{cache}:{'hits' if hit else 'misses'}")
+
+
+def cache_metrics():
+    counters = {key.decode(): int(value) for key, value in r.hgetall(CACHE_METRICS).items()} if r is not None else {}
+    evictions = counters.pop("distance_files:evictions", 0)
+    metrics = {}
+    for field, count in counters.items():
+        cache, counter = field.rsplit(":", 1)
+        metrics.setdefault(cache, {"hits": 0, "misses": 0})[counter] = count
+    for counts in metrics.values():
+        requests = counts["hits"] + counts["misses"]
+        counts["hit_rate"] = counts["hits"] / requests if requests > 0 else None
+    files = distance_files()
+    metrics["distance_files"] = {
+        "count": len(files),
+        "bytes": sum(size for _, size, _ in files),
+        "budget": DISTANCE_BUDGET,
+        "evictions": evictions,
+    }
+    return metrics
 
 
 def invalidate_caches(BID: str):
-    for key in r.scan_iter(f"{CACHE_CLUSTERING}:{BID}:*"):
-        r.delete(key)
-    for key in r.scan_iter(f"{CACHE_DTW}:{BID}:*"):
-        r.delete(key)
+    if r is not None:
+        r.incr(f"{CACHE_VERSION}:{str(BID)}")
+        for key in r.scan_iter(f"{CACHE_CLUSTERING}:{BID}:*"):
+            r.delete(key)
+    for path in glob.glob(os.path.join(DISTANCE_DIR, str(BID), "matrix_*.npy")):
+        Path(path).unlink(missing_ok=True)
+    invalidate_baseline_min_max(BID)
 
 
-def store_cluster_tree(BID: str, tree, anomalies_or_timeseries: str):
+def invalidate_baseline_min_max(BID: str):
     if r is not None:
-        r.set(f"{CACHE_CLUSTERING}:{str(BID)}:{anomalies_or_timeseries}", json.dumps(tree))
+        r.delete(f"{CACHE_BASELINE_MIN_MAX}:{str(BID)}")
 
 
-def get_cluster_tree(BID: str, key: str, anomalies_or_timeseries: str):
-    if key not in conf["cache"]["keys"]:
-        raise KeyError("Cache key not found")
+def store_baseline_min_max(BID: str, baseline: list):
     if r is not None:
-        cache = r.get(f'{conf["cache"]["keys"][key]}:{str(BID)}:{anomalies_or_timeseries}')
+        r.set(f"{CACHE_BASELINE_MIN_MAX}:{str(BID)}", pickle.dumps(baseline), ex=CACHE_TTL)
+
+
+def get_baseline_min_max(BID: str):
+    if r is not None:
+        cache = r.get(f"{CACHE_BASELINE_MIN_MAX}:{str(BID)}")
+        record_access("baseline_min_max", cache is not None)
         if cache is not None:
-            return json.loads(cache)
+            return pickle.loads(cache)
     return None
 
 
-def store_dtw_matrix(BID: str, dtw: np.array, anomalies_or_timeseries: str):
+def store_cluster_tree(key: str, tree):
     if r is not None:
-        r.set(f"{CACHE_DTW}:{str(BID)}:{anomalies_or_timeseries}", pickle.dumps(dtw))
+        r.set(f"{CACHE_CLUSTERING}:{key}", json.dumps(tree), ex=CACHE_TTL)
 
 
-def get_dtw_matrix(BID: str, anomalies_or_timeseries: str):
+def get_cluster_tree(key: str):
     if r is not None:
-        cache = r.get(f'{CACHE_DTW}:{str(BID)}:{anomalies_or_timeseries}')
+        cache = r.getex(f"{CACHE_CLUSTERING}:{key}", ex=CACHE_TTL)
+        record_access("cluster_tree", cache is not None)
         if cache is not None:
-            dtw = pickle.loads(cache)
-            return dtw
+            return json.loads(cache)
     return None
 
 
+def new_distance_matrix(BID: str, n: int):
+    # writable n x n matrix in a temporary file, it becomes visible with store_dtw_matrix or store_dtw_distances
+    directory = os.path.join(DISTANCE_DIR, str(BID))
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, prefix="distances_", suffix=".npy.tmp")
+    os.close(fd)
+    return np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(n, n))
+
+
+def load_distance_matrix(path: str):
+    try:
+        dtw = np.load(path, mmap_mode="r")
+    except FileNotFoundError:
+        return None
+    # the modification time is the last use for the eviction
+    Path(path).touch()
+    return dtw
+
+
+def distance_files():
+    files = []
+    for path in glob.glob(os.path.join(DISTANCE_DIR, "*", "matrix_*.npy")) + glob.glob(
+            os.path.join(DISTANCE_DIR, "*", "distances_*.npy")):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    return files
+
+
+def evict_distance_files():
+    # the most recently used file is kept even if it alone exceeds the budget
+    files = sorted(distance_files(), reverse=True)
+    used = 0
+    for i, (mtime, size, path) in enumerate(files):
+        used += size
+        if i > 0 and (used > DISTANCE_BUDGET or time.time() - mtime > CACHE_TTL):
+            Path(path).unlink(missing_ok=True)
+            used -= size
+            if r is not None:
+                r.hincrby(CACHE_METRICS, "distance_files:evictions")
+
+
+def matrix_path(key: str):
+    BID = key.split(":", 1)[0]
+    return os.path.join(DISTANCE_DIR, BID, f"matrix_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]}.npy")
+
+
+def store_dtw_matrix(key: str, dtw: np.array):
+    matrix = new_distance_matrix(key.split(":", 1)[0], len(dtw))
+    matrix[:] = dtw
+    matrix.flush()
+    os.replace(matrix.filename, matrix_path(key))
+    evict_distance_files()
+    return load_distance_matrix(matrix_path(key))
+
+
+def get_dtw_matrix(key: str):
+    dtw = load_distance_matrix(matrix_path(key))
+    record_access("distance_matrix", dtw is not None)
+    return dtw
+
+
+# pairwise anomaly distances keyed by anomaly id, they stay valid when anomalies are added or deleted and are therefore
+# not part of invalidate_caches. The index names the matrix file, replacing the index publishes ids and matrix at once.
+def distances_index_path(BID: str, window: int | None):
+    return os.path.join(DISTANCE_DIR, str(BID), f"anomaly_distances_{window}.json")
+
+
+def store_dtw_distances(BID: str, AIDs: list, dtw: np.memmap, window: int | None):
+    dtw.flush()
+    index_path = distances_index_path(BID, window)
+    path = dtw.filename.removesuffix(".tmp")
+    os.replace(dtw.filename, path)
+    previous = get_dtw_distances_index(BID, window)
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump({"AIDs": AIDs, "matrix": os.path.basename(path)}, f)
+    os.replace(f"{index_path}.tmp", index_path)
+    # readers that still map the previous matrix keep their copy until they are done
+    if previous is not None and previous["matrix"] != os.path.basename(path):
+        Path(os.path.join(DISTANCE_DIR, str(BID), previous["matrix"])).unlink(missing_ok=True)
+    evict_distance_files()
+    return load_distance_matrix(path)
+
+
+def get_dtw_distances_index(BID: str, window: int | None):
+    try:
+        with open(distances_index_path(BID, window)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def get_dtw_distances(BID: str, window: int | None):
+    index = get_dtw_distances_index(BID, window)
+    dtw = load_distance_matrix(os.path.join(DISTANCE_DIR, str(BID), index["matrix"])) if index is not None else None
+    record_access("anomaly_distances", dtw is not None)
+    if dtw is None:
+        return None
+    return index["AIDs"], dtw
+
+
 if __name__ == '__main__':
     invalidate_caches("68078e56ed3882b302ae3b2a")
@@ -1,15 +1,98 @@
+import heapq
 import json
 import math
+import sys
+import time
 
 import dtaidistance
 import numpy as np
 import scipy.cluster.hierarchy as hierarchy
-import scipy.spatial.distance as ssd
 from bson import ObjectId
 from sklearn.preprocessing import MinMaxScaler
 
 import backend.helper.caching as caching
 import backend.helper.database as database
+from backend.helper.config import get_config
+
+conf = get_config()
+# window is the Sakoe-Chiba band in points (None = unconstrained), dtaidistance widens it to the length difference of
+# two series. parallel spreads matrix computations over all cores.
+DTW_WINDOW = conf["dtw"]["window"]
+DTW_PARALLEL = conf["dtw"]["parallel"]
+# rows of new anomalies computed at once, bounds the memory of an update of the stored distances
+DTW_BLOCK_ROWS = 256
+
+
+def dtw_distances(tsData, block=None, compact=False, window: int | None = DTW_WINDOW, parallel: bool = DTW_PARALLEL):
+    return dtaidistance.dtw.distance_matrix_fast(tsData, block=block, compact=compact, window=window,
+                                                 parallel=parallel)
+
+
+def lb_kim(first: np.ndarray, last: np.ndarray, lengths: np.ndarray, query: int):
+    # every warping path contains the first and the last pair of points, these coincide only for two single points
+    first_term = (first - first[query]) ** 2
+    last_term = np.where((lengths == 1) & (lengths[query] == 1), 0, (last - last[query]) ** 2)
+    return np.sqrt(first_term + last_term)
+
+
+def lb_yi(padded: np.ndarray, minimum: np.ndarray, maximum: np.ndarray, query: int):
+    # every point of one series is matched at least once, at best to a value within the range of the other series
+    values = padded[query][~np.isnan(padded[query])]
+    query_to_candidates = np.sum((values - np.clip(values, minimum[:, None], maximum[:, None])) ** 2, axis=1)
+    outside = padded - np.clip(padded, minimum[query], maximum[query])
+    candidates_to_query = np.nansum(outside ** 2, axis=1)
+    return np.sqrt(np.maximum(query_to_candidates, candidates_to_query))
+
+
+def dtw_knn(tsData, k: int, queries: list = None, window: int | None = DTW_WINDOW):
+    # exact k nearest neighbours (excluding the series itself) of every query series, an alternative to the full matrix
+    # for callers that only need the nearest series. Candidates are visited in the order of their LB_Kim/LB_Yi bound
+    # until it reaches the current k-th distance, with a window LB_Keogh skips further candidates and the full DTW is
+    # abandoned as soon as it exceeds the k-th distance.
+    series = [np.asarray(s, dtype=np.double) for s in tsData]
+    first = np.array([s[0] for s in series])
+    last = np.array([s[-1] for s in series])
+    minimum = np.array([np.min(s) for s in series])
+    maximum = np.array([np.max(s) for s in series])
+    lengths = np.array([len(s) for s in series])
+    padded = np.full((len(series), np.max(lengths, initial=0)), np.nan)
+    for i, s in enumerate(series):
+        padded[i, :len(s)] = s
+    queries = range(len(series)) if queries is None else queries
+    k = min(k, len(series) - 1)
+    indices = np.full((len(queries), k), -1, dtype=np.int64)
+    distances = np.full((len(queries), k), np.inf)
+    band = {"window": window} if window is not None else {}
+    for row, query in enumerate(queries):
+        bounds = np.maximum(lb_kim(first, last, lengths, query), lb_yi(padded, minimum, maximum, query))
+        bounds[query] = np.inf
+        nearest = []
+        for candidate in np.argsort(bounds):
+            if candidate == query:
+                continue
+            worst = -nearest[0][0] if len(nearest) == k else np.inf
+            if bounds[candidate] >= worst:
+                break
+            # dtaidistance's own pruning bound is wrong for series of very different lengths, hence use_pruning=False
+            if worst < np.inf:
+                # without a window the envelope of LB_Keogh is the range of the series, which LB_Yi already covers
+                if window is not None and dtaidistance.dtw.lb_keogh(series[query], series[candidate], use_c=True,
+                                                                    **band) >= worst:
+                    continue
+                distance = dtaidistance.dtw.distance_fast(series[query], series[candidate], use_pruning=False,
+                                                          max_dist=worst, **band)
+            else:
+                distance = dtaidistance.dtw.distance_fast(series[query], series[candidate], use_pruning=False,
+                                                          **band)
+            if distance < worst:
+                if len(nearest) == k:
+                    heapq.heapreplace(nearest, (-distance, candidate))
+                else:
+                    heapq.heappush(nearest, (-distance, candidate))
+        nearest = sorted((-distance, candidate) for distance, candidate in nearest)
+        indices[row, :len(nearest)] = [candidate for _, candidate in nearest]
+        distances[row, :len(nearest)] = [distance for distance, _ in nearest]
+    return indices, distances
 
 
 def get_anomaly_data_for_clustering(BID):
@@ -60,18 +143,72 @@ def get_clustering_data(BID, anomalies_or_timeseries="anomalies", channel=None):
     return tsData, meta
 
 
-def dtw_matrix(BID, tsData=None, anomalies_or_timeseries="anomalies", channel=None):
-    y = caching.get_dtw_matrix(BID, anomalies_or_timeseries)
+def anomaly_dtw_matrix(BID, tsData=None, AIDs=None):
+    # rows follow the order of get_anomalies, only pairs with an anomaly that is not in the store yet are computed.
+    # Callers that already read the anomalies pass their series and ids, the new rows need the series of all of them.
+    if AIDs is None:
+        AIDs = [str(AID) for AID in database.get_anomaly_ids(database.get_db(), ObjectId(BID))]
+    stored_AIDs, stored = caching.get_dtw_distances(BID, DTW_WINDOW) or ([], None)
+    if AIDs == stored_AIDs:
+        return stored
+    index = {AID: i for i, AID in enumerate(stored_AIDs)}
+    if tsData is None and any(AID not in index for AID in AIDs):
+        tsData, meta = get_anomaly_data_for_clustering(BID)
+        AIDs = [m["AID"] for m in meta]
+    y = caching.new_distance_matrix(BID, len(AIDs))
+    new = np.array([i for i, AID in enumerate(AIDs) if AID not in index], dtype=np.int64)
+    kept = np.array([i for i, AID in enumerate(AIDs) if AID in index], dtype=np.int64)
+    if len(new) > 0:
+        # new anomalies first, blocks over their rows yield their distances to all later anomalies, the distances to
+        # earlier ones are already in the rows written before
+        order = np.concatenate([new, kept])
+        series = [tsData[i] for i in order]
+        for start in range(0, len(new), DTW_BLOCK_ROWS):
+            end = min(start + DTW_BLOCK_ROWS, len(new))
+            distances = np.asarray(dtw_distances(series, block=((start, end), (0, len(order))), compact=True))
+            offset = 0
+            for row in range(start, end):
+                y[order[row], order[row + 1:]] = distances[offset:offset + len(order) - row - 1]
+                y[order[row], order[row]] = 0
+                y[order[row], order[:row]] = y[order[:row], order[row]]
+                offset += len(order) - row - 1
+    kept_positions = np.array([index[AIDs[i]] for i in kept], dtype=np.int64)
+    for i, position in zip(kept, kept_positions):
+        y[i, kept] = stored[position][kept_positions]
+        y[i, new] = y[new, i]
+    return caching.store_dtw_distances(BID, AIDs, y, DTW_WINDOW)
+
+
+def condensed_distances(y):
+    # upper triangle row by row, squareform would first compare the whole matrix against its transpose
+    n = len(y)
+    condensed = np.empty(n * (n - 1) // 2)
+    start = 0
+    for i in range(n - 1):
+        condensed[start:start + n - i - 1] = y[i, i + 1:]
+        start += n - i - 1
+    return condensed
+
+
+def cache_key(BID, anomalies_or_timeseries="anomalies", channel=None):
+    # key of results derived from the DTW matrix, taken before the data is read
+    return caching.cache_key(BID, anomalies_or_timeseries, channel, f"dtw-{DTW_WINDOW}")
+
+
+def dtw_matrix(BID, tsData=None, anomalies_or_timeseries="anomalies", channel=None, key=None, ids=None):
+    if anomalies_or_timeseries == "anomalies":
+        return anomaly_dtw_matrix(str(BID), tsData, ids)
+    key = key or cache_key(BID, anomalies_or_timeseries, channel)
+    y = caching.get_dtw_matrix(key)
     if y is not None:
         return y
     if tsData is None:
         tsData, _ = get_clustering_data(BID, anomalies_or_timeseries, channel)
-    y = dtaidistance.dtw.distance_matrix_fast(tsData)
-    caching.store_dtw_matrix(BID, y, anomalies_or_timeseries)
-    return y
+    return caching.store_dtw_matrix(key, dtw_distances(tsData))
 
 
 def cluster(BID, anomalies_or_timeseries="anomalies", channel=None):
+    key = cache_key(BID, anomalies_or_timeseries, channel)
     tsData, meta = get_clustering_data(BID, anomalies_or_timeseries, channel)
     if len(tsData) == 0:
         return None, {}
@@ -83,16 +220,40 @@ def cluster(BID, anomalies_or_timeseries="anomalies", channel=None):
         right = convert_tree(node.right)
         return {"id": node.id, "dist": node.dist, "left": left, "right": right}
 
-    y = dtw_matrix(BID, tsData, anomalies_or_timeseries, channel)
-    distArray = ssd.squareform(y)
-    hier_clust = hierarchy.linkage(distArray, method="ward")
+    ids = [m["AID"] for m in meta] if anomalies_or_timeseries == "anomalies" else None
+    y = dtw_matrix(BID, tsData, anomalies_or_timeseries, channel, key, ids)
+    hier_clust = hierarchy.linkage(condensed_distances(y), method="ward")
     linkage_tree = hierarchy.to_tree(hier_clust)
     json_tree = convert_tree(linkage_tree)
     return hier_clust, json_tree
 
 
 
+def benchmark_dtw(sizes=(1000, 5000, 10000), k=5, window=20):
+    # random walks with the length spread of extracted anomalies, the full matrix (serial, parallel, windowed) against
+    # the pruned k-NN search, whose neighbours are checked against the rows of the matrix
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        tsData = [np.cumsum(rng.normal(size=rng.integers(20, 200))) for _ in range(size)]
+        matrices = {}
+        for parallel, band in [(False, None), (True, None), (True, window)]:
+            start = time.time()
+            matrices[band] = np.asarray(dtw_distances(tsData, window=band, parallel=parallel))
+            print(f"{size} series, matrix, parallel={parallel}, window={band}: {time.time() - start:.2f}s")
+        for band in [None, window]:
+            start = time.time()
+            _, distances = dtw_knn(tsData, k, window=band)
+            elapsed = time.time() - start
+            matrix = matrices[band].copy()
+            np.fill_diagonal(matrix, np.inf)
+            exact = np.allclose(distances, np.sort(matrix, axis=1)[:, :k])
+            print(f"{size} series, {k}-NN, window={band}: {elapsed:.2f}s, same distances as the matrix: {exact}")
+
+
 if __name__ == "__main__":
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark_dtw()
+        sys.exit()
     BID = "67e51223793e540b137faae6"
     hier_clust, json_tree = cluster(ObjectId(BID), "timeseries", "value")
     # with open("res.json", "w") as f:
@@ -1,5 +1,8 @@
+import contextlib
+import contextvars
 import copy
 import datetime
+import hashlib
 import json
 import math
 import os
@@ -14,10 +17,10 @@ import numpy as np
 import pandas as pd
 import pymongo
 import redis
-from bson import json_util
+import bson
+import flask
 from bson.objectid import ObjectId
 from dateutil import parser
-from fastdtw import fastdtw
 from pymongo.database import Database
 from scipy.signal import savgol_filter
 from sklearn.preprocessing import MinMaxScaler
@@ -27,18 +30,59 @@ from tslearn.preprocessing import TimeSeriesResampler
 
 import backend.helper.caching as caching
 import backend.helper.clustering as clustering
+import backend.helper.lod as lod
+import backend.helper.score_store as score_store
+import backend.helper.similarity as similarity
 from backend.helper.config import get_config
-from backend.helper.query import QueryTimeseries
+from backend.helper.json_provider import dumps_mongodb
+from backend.helper.query import QueryTimeseries, bucket_metadata
 from backend.helper.util import get_ts_labels, truncate_datetime_to_iso, iso_to_date_range
 
 conf = get_config()
 CACHE_BASELINE_MIN_MAX = conf["cache"]["keys"]["BASELINE_MIN_MAX"]
 r = redis.Redis(host=conf["scheduler"]["redis"]["host"], port=conf["scheduler"]["redis"]["port"], db=1)
+# bucket, timeseries and algorithm documents read by the current scheduler job, requests keep theirs in flask.g
+job_metadata = contextvars.ContextVar("job_metadata", default=None)
 
 
 def serialize_mongodb(output):
-    temp = json.dumps(output, default=json_util.default)
-    return json.loads(temp)
+    # encodes straight into the response body, extended JSON ($oid, $date) is what the frontend expects here
+    return flask.Response(dumps_mongodb(output), mimetype="application/json")
+
+
+def metadata_cache():
+    # None outside of requests and metadata scopes, every read then goes to the database
+    cache = job_metadata.get()
+    if cache is None and flask.has_app_context():
+        if "metadata" not in flask.g:
+            flask.g.metadata = {}
+        cache = flask.g.metadata
+    return cache
+
+
+@contextlib.contextmanager
+def metadata_scope():
+    token = job_metadata.set({})
+    try:
+        yield
+    finally:
+        job_metadata.reset(token)
+
+
+def cached_metadata(key: tuple, load):
+    cache = metadata_cache()
+    if cache is None:
+        return load()
+    if key not in cache:
+        cache[key] = load()
+    return cache[key]
+
+
+def invalidate_metadata():
+    # writes are rare compared to reads, so any write drops everything cached in the scope
+    cache = metadata_cache()
+    if cache is not None:
+        cache.clear()
 
 
 def get_db() -> Database:
@@ -63,11 +107,26 @@ def init_db(db: Database):
     db["anomalyScores"].create_index({"ids.BID": 1})
     db["anomalyScores"].create_index({"ids.AlgoID": 1})
     db["anomalyScores"].create_index({"timestamp": 1})
+    db.create_collection('scoreChunks')
+    db["scoreChunks"].create_index({"TID": 1, "AlgoID": 1, "channel": 1, "chunk": 1})
+    db["scoreChunks"].create_index({"BID": 1})
+    db["scoreChunks"].create_index({"AlgoID": 1})
     db.create_collection('buckets')
     db.create_collection('timeSeries')
     db.create_collection('anomalies')
     db.create_collection('algorithms')
     db.create_collection('anomalyClassifications')
+    db.create_collection('scoreFingerprints')
+    db["scoreFingerprints"].create_index({"TID": 1, "AlgoID": 1, "channel": 1})
+    db.create_collection('lodTiles')
+    db["lodTiles"].create_index({"TID": 1, "AlgoID": 1, "channel": 1, "level": 1, "chunk": 1})
+    db.create_collection('lodSeries')
+    db["lodSeries"].create_index({"TID": 1, "AlgoID": 1, "channel": 1})
+    db.create_collection('scoreStats')
+    db["scoreStats"].create_index({"TID": 1, "AlgoID": 1, "channel": 1})
+    db["scoreStats"].create_index({"BID": 1, "channel": 1, "AlgoID": 1})
+    db.create_collection('scoreBaselines')
+    db["scoreBaselines"].create_index({"BID": 1, "channel": 1, "AlgoID": 1})
 
 
 def verify_id(db: Database, id_to_check: str, collection: str):
@@ -94,6 +153,7 @@ def create_bucket(db: Database, name: str, type: str, class_gran: str):
         }
     )
     add_default_algorithms(db, bucket.inserted_id, type)
+    invalidate_metadata()
     return bucket.inserted_id
 
 
@@ -102,23 +162,32 @@ def list_buckets(db: Database):
 
 
 def get_bucket(db: Database, BID: ObjectId):
-    return db["buckets"].find_one({"_id": BID})
+    return cached_metadata(("bucket", BID), lambda: db["buckets"].find_one({"_id": BID}))
 
 
 def rename_bucket(db: Database, BID: ObjectId, name: str):
     db["buckets"].update_one({"_id": BID}, {"$set": {"name": name}})
+    invalidate_metadata()
 
 
 def set_threshold(db: Database, BID: ObjectId, threshold: float):
     db["buckets"].update_one({"_id": BID}, {"$set": {"threshold": threshold}})
+    invalidate_metadata()
 
 
 def set_smoothing_window(db: Database, BID: ObjectId, smoothing_window: int):
     db["buckets"].update_one({"_id": BID}, {"$set": {"smoothing_window": smoothing_window}})
+    invalidate_metadata()
+
+
+def set_shared_model(db: Database, BID: ObjectId, shared_model: bool):
+    db["buckets"].update_one({"_id": BID}, {"$set": {"shared_model": shared_model}})
+    invalidate_metadata()
 
 
 def set_classification_ensemble(db: Database, BID: ObjectId, ensemble_method: str):
     db["buckets"].update_one({"_id": BID}, {"$set": {"classification_ensemble": ensemble_method}})
+    invalidate_metadata()
 
 
 def delete_bucket(db: Database, BID: ObjectId):
@@ -128,11 +197,18 @@ def delete_bucket(db: Database, BID: ObjectId):
         db["anomalies"].delete_many({"TID": ts["_id"]})
     db["timeSeries"].delete_many({"BID": BID})
     db["alerts"].delete_many({"BID": BID})
+    score_store.delete_all_scores(db, {"BID": BID})
+    db["scoreFingerprints"].delete_many({"BID": BID})
+    lod.delete_pyramids(db, {"BID": BID})
+    db["scoreStats"].delete_many({"BID": BID})
+    db["scoreBaselines"].delete_many({"BID": BID})
     db["buckets"].delete_one({"_id": BID})
+    invalidate_metadata()
     dirpath = Path(os.path.join(Path(__file__).parents[1], "anomaly_detection", "models", str(BID)))
     if dirpath.exists() and dirpath.is_dir():
         shutil.rmtree(dirpath)
     caching.invalidate_caches(str(BID))
+    similarity.drop_bucket(BID)
 
 
 def bucket_channels(db: Database, BID: ObjectId):
@@ -180,24 +256,40 @@ def add_default_algorithms(db: Database, BID: ObjectId, algo_type: str = "scorin
             "algorithm": algorithm
         }
         db["algorithms"].insert_one(algo)
+    invalidate_metadata()
 
 
 def add_algorithm(db: Database, BID: ObjectId, algorithm: str, name: str):
-    return db["algorithms"].insert_one(
+    AlgoID = db["algorithms"].insert_one(
         {**conf["algorithms"][algorithm], "BID": BID, "name": name, "algorithm": algorithm}).inserted_id
+    invalidate_metadata()
+    return AlgoID
 
 
 def get_bucket_algorithms(db: Database, BID: ObjectId):
-    return list(db["algorithms"].find({"BID": BID}))
+    return list(cached_metadata(("algorithms", BID), lambda: list(db["algorithms"].find({"BID": BID}))))
+
+
+def get_algorithm(db: Database, AlgoID: ObjectId):
+    return db["algorithms"].find_one({"_id": AlgoID})
 
 
 def update_algorithm(db: Database, AlgoID: ObjectId, new_conf):
     db["algorithms"].update_one({"_id": AlgoID}, {"$set": new_conf})
+    invalidate_metadata()
 
 
 def delete_algorithm(db: Database, AlgoID: ObjectId):
+    algorithm = get_algorithm(db, AlgoID)
     db["algorithms"].delete_one({"_id": AlgoID})
-    db["anomalyScores"].delete_many({"ids.AlgoID": AlgoID})
+    invalidate_metadata()
+    score_store.delete_all_scores(db, {"AlgoID": AlgoID})
+    db["scoreFingerprints"].delete_many({"AlgoID": AlgoID})
+    lod.delete_pyramids(db, {"AlgoID": AlgoID})
+    db["scoreStats"].delete_many({"AlgoID": AlgoID})
+    db["scoreBaselines"].delete_many({"AlgoID": AlgoID})
+    if algorithm is not None:
+        caching.invalidate_baseline_min_max(str(algorithm["BID"]))
     db["anomalyClassifications"].delete_many({"algo": AlgoID})
 
 
@@ -206,11 +298,11 @@ def delete_algorithm(db: Database, AlgoID: ObjectId):
 # ----------------------------------------------
 
 def list_timeseries(db: Database, BID: ObjectId):
-    return list(db["timeSeries"].find({"BID": BID}))
+    return list(cached_metadata(("timeseries_list", BID), lambda: list(db["timeSeries"].find({"BID": BID}))))
 
 
 def get_timeseries(db: Database, TID: ObjectId):
-    return db["timeSeries"].find_one({"_id": TID})
+    return cached_metadata(("timeseries", TID), lambda: db["timeSeries"].find_one({"_id": TID}))
 
 
 def get_timeseries_channels(db: Database, TID: ObjectId):
@@ -222,6 +314,7 @@ def create_timeseries_entry(db: Database, BID: ObjectId, name: str, channels: li
     result = db["timeSeries"].insert_one(
         {"name": name, "BID": BID, "channels": channels}
     )
+    invalidate_metadata()
     return result.inserted_id
 
 
@@ -229,8 +322,15 @@ def delete_timeseries(db: Database, TID: ObjectId):
     ts = db["timeSeries"].find_one({"_id": TID})
     caching.invalidate_caches(str(ts["BID"]))
     db["timeSeries"].delete_one({"_id": TID})
+    invalidate_metadata()
     db["timeSeriesData"].delete_many({"ids.TID": TID})
-    db["anomalyScores"].delete_many({"ids.TID": TID})
+    score_store.delete_all_scores(db, {"TID": TID})
+    db["scoreFingerprints"].delete_many({"TID": TID})
+    lod.delete_pyramids(db, {"TID": TID})
+    stats = list(db["scoreStats"].find({"TID": TID}))
+    db["scoreStats"].delete_many({"TID": TID})
+    for channel, AlgoID in {(stat["channel"], stat["AlgoID"]) for stat in stats}:
+        update_score_baseline(db, ts["BID"], channel, AlgoID)
     anomalies = db["anomalies"].find({"TID": TID})
     for anomaly in anomalies:
         db["alerts"].delete_many({"AID_alert": anomaly["_id"]})
@@ -240,6 +340,7 @@ def delete_timeseries(db: Database, TID: ObjectId):
 
 def rename_timeseries(db: Database, TID: ObjectId, name: str):
     db["timeSeries"].update_one({"_id": TID}, {"$set": {"name": name}})
+    invalidate_metadata()
 
 
 def parse_csv(csv_string: str):
@@ -254,8 +355,8 @@ def parse_csv(csv_string: str):
     return json_items, [c for c in df.columns if c != "timestamp"]
 
 
-def import_timeseries(db: Database, json_items: list, TID: ObjectId, BID: ObjectId):
-    dt = datetime.datetime.now()
+def timeseries_documents(json_items: list, TID: ObjectId, BID: ObjectId, default_start: datetime.datetime):
+    dt = copy.deepcopy(default_start)
     def parse_timestamp(item):
         if "timestamp" in item:
             timestamp_value = item["timestamp"]
@@ -283,7 +384,104 @@ def import_timeseries(db: Database, json_items: list, TID: ObjectId, BID: Object
         time_series.append(temp)
         dt += datetime.timedelta(seconds=1)
     time_series.sort(key=lambda s: s["timestamp"])
+    return time_series
+
+
+def import_timeseries(db: Database, json_items: list, TID: ObjectId, BID: ObjectId):
+    time_series = timeseries_documents(json_items, TID, BID, datetime.datetime.now())
+    db["timeSeriesData"].insert_many(time_series)
+    timestamps = [item["timestamp"] for item in time_series]
+    for channel in (time_series[0]["values"] if len(time_series) > 0 else []):
+        values = np.fromiter((item["values"][channel] for item in time_series), dtype=np.float64, count=len(time_series))
+        lod.build_pyramid(db, BID, TID, channel, None, timestamps, values)
+    caching.invalidate_caches(str(BID))
+
+
+def append_timeseries(db: Database, json_items: list, TID: ObjectId):
+    ts = get_timeseries(db, TID)
+    last = db["timeSeriesData"].find_one({"ids.TID": TID}, {"timestamp": 1}, sort=[("timestamp", pymongo.DESCENDING)])
+    last_timestamp = last["timestamp"] if last is not None else None
+    default_start = last_timestamp + datetime.timedelta(seconds=1) if last_timestamp is not None else datetime.datetime.now()
+    time_series = timeseries_documents(json_items, TID, ts["BID"], default_start)
+    for item in time_series:
+        if set(item["values"].keys()) != set(ts["channels"]):
+            raise ValueError(f"Every data point must provide exactly the channels {', '.join(ts['channels'])}")
+    # only points after the current end of the series can be appended, the stored scores stay valid this way
+    time_series = [item for item in time_series if last_timestamp is None or item["timestamp"] > last_timestamp]
+    if len(time_series) == 0:
+        return None
     db["timeSeriesData"].insert_many(time_series)
+    timestamps = [item["timestamp"] for item in time_series]
+    for channel in ts["channels"]:
+        values = np.fromiter((item["values"][channel] for item in time_series), dtype=np.float64, count=len(time_series))
+        if not lod.extend_pyramid(db, ts["BID"], TID, channel, None, timestamps, values):
+            build_timeseries_pyramid(db, TID, channel)
+    caching.invalidate_caches(str(ts["BID"]))
+    return time_series[0]["timestamp"]
+
+
+def build_timeseries_pyramid(db: Database, TID: ObjectId, channel: str):
+    timestamps, columns = read_timeseries_columns(db, TID, [channel])
+    lod.build_pyramid(db, get_timeseries(db, TID)["BID"], TID, channel, None, timestamps, columns[channel])
+
+
+def read_timeseries_columns(db: Database, TID: ObjectId, channels: list, query: dict = None,
+                            direction=pymongo.ASCENDING, limit: int = 0):
+    # decodes raw bson batches straight into one array per channel, only a single batch of documents is alive at a time
+    projection = {"_id": 0, "timestamp": 1, **{f"values.{channel}": 1 for channel in channels}}
+    cursor = db["timeSeriesData"].find_raw_batches({"ids.TID": TID, **(query or {})}, projection,
+                                                   sort=[("timestamp", direction)], limit=limit)
+    timestamps = []
+    chunks = {channel: [] for channel in channels}
+    for batch in cursor:
+        documents = bson.decode_all(batch)
+        timestamps.extend(document["timestamp"] for document in documents)
+        for channel in channels:
+            chunks[channel].append(np.fromiter((document["values"][channel] for document in documents),
+                                               dtype=np.float64, count=len(documents)))
+    columns = {channel: np.concatenate(chunks[channel]) if chunks[channel] else np.empty(0) for channel in channels}
+    # descending reads fetch the last points of a series, they are still returned in chronological order
+    if direction == pymongo.DESCENDING:
+        timestamps = timestamps[::-1]
+        columns = {channel: values[::-1] for channel, values in columns.items()}
+    return timestamps, columns
+
+
+def get_data_fingerprint(db: Database, TID: ObjectId):
+    last = db["timeSeriesData"].find_one({"ids.TID": TID}, {"timestamp": 1}, sort=[("timestamp", pymongo.DESCENDING)])
+    return {
+        "TID": TID,
+        "rows": db["timeSeriesData"].count_documents({"ids.TID": TID}),
+        "last_timestamp": last["timestamp"] if last is not None else None
+    }
+
+
+def get_config_fingerprint(method: str, parameters: dict, shared_model: bool = False):
+    config = {"method": method, "parameters": parameters}
+    if shared_model:
+        config["shared_model"] = True
+    config = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(config.encode("utf-8")).hexdigest()
+
+
+def get_score_fingerprint(db: Database, TID: ObjectId, AlgoID: ObjectId, channel: str):
+    return db["scoreFingerprints"].find_one({"TID": TID, "AlgoID": AlgoID, "channel": channel})
+
+
+def score_fingerprint_matches(db: Database, TID: ObjectId, AlgoID: ObjectId, channel: str, data_fingerprint: dict,
+                              config_fingerprint: str):
+    fingerprint = get_score_fingerprint(db, TID, AlgoID, channel)
+    return (fingerprint is not None and fingerprint["data"] == data_fingerprint
+            and fingerprint["config"] == config_fingerprint)
+
+
+def set_score_fingerprint(db: Database, BID: ObjectId, TID: ObjectId, AlgoID: ObjectId, channel: str,
+                          data_fingerprint: dict, config_fingerprint: str):
+    db["scoreFingerprints"].update_one(
+        {"TID": TID, "AlgoID": AlgoID, "channel": channel},
+        {"$set": {"BID": BID, "data": data_fingerprint, "config": config_fingerprint}},
+        upsert=True
+    )
 
 
 def calculate_zoom_level(db: Database, TID: ObjectId, from_date: datetime.datetime, to_date: datetime.datetime):
@@ -298,51 +496,139 @@ def calculate_zoom_level(db: Database, TID: ObjectId, from_date: datetime.dateti
     return round(1 - window_timestamp / total_timespan, 2)
 
 
+def score_stats_extremes(db: Database, key: dict):
+    stats = list(db["scoreStats"].aggregate([
+        {"$match": key},
+        {"$group": {"_id": None, "minScore": {"$min": "$minScore"}, "maxScore": {"$max": "$maxScore"}}}
+    ]))
+    return stats[0] if len(stats) > 0 else None
+
+
+def update_score_baseline(db: Database, BID: ObjectId, channel: str, AlgoID: ObjectId):
+    # recomputes the bucket baseline from the per series stats, these are a handful of documents per series
+    key = {"BID": BID, "channel": channel, "AlgoID": AlgoID}
+    stats = score_stats_extremes(db, key)
+    if stats is None:
+        db["scoreBaselines"].delete_one(key)
+    else:
+        db["scoreBaselines"].replace_one(key, {**key, "minScore": stats["minScore"], "maxScore": stats["maxScore"]},
+                                         upsert=True)
+    # another worker may have written its stats and widened the baseline between the read and the write above, its
+    # stats are in the collection by now and are applied again the same commutative way set_score_stats widens
+    stats = score_stats_extremes(db, key)
+    if stats is not None:
+        db["scoreBaselines"].update_one(key, {"$min": {"minScore": stats["minScore"]},
+                                              "$max": {"maxScore": stats["maxScore"]}}, upsert=True)
+    caching.invalidate_baseline_min_max(str(BID))
+
+
+def set_score_stats(db: Database, BID: ObjectId, TID: ObjectId, AlgoID: ObjectId, channel: str, min_score: float,
+                    max_score: float):
+    key = {"TID": TID, "AlgoID": AlgoID, "channel": channel}
+    previous = db["scoreStats"].find_one_and_replace(
+        key, {**key, "BID": BID, "minScore": min_score, "maxScore": max_score}, upsert=True)
+    baseline_key = {"BID": BID, "channel": channel, "AlgoID": AlgoID}
+    shrunk = previous is not None and (min_score > previous["minScore"] or max_score < previous["maxScore"])
+    baseline = db["scoreBaselines"].find_one(baseline_key) if shrunk else None
+    if baseline is not None and (previous["minScore"] <= baseline["minScore"] or
+                                 previous["maxScore"] >= baseline["maxScore"]):
+        # this series held an extreme of the bucket that is now gone, only a recomputation can find the new one
+        update_score_baseline(db, BID, channel, AlgoID)
+    else:
+        # widening is commutative, so concurrent scoring workers cannot lose each other's updates
+        db["scoreBaselines"].update_one(baseline_key,
+                                        {"$min": {"minScore": min_score}, "$max": {"maxScore": max_score}},
+                                        upsert=True)
+        caching.invalidate_baseline_min_max(str(BID))
+
+
+def extend_score_stats(db: Database, BID: ObjectId, TID: ObjectId, AlgoID: ObjectId, channel: str, min_score: float,
+                       max_score: float):
+    # merges the stats of scores appended to a series with the stats of its existing scores
+    previous = db["scoreStats"].find_one({"TID": TID, "AlgoID": AlgoID, "channel": channel})
+    if previous is None:
+        refresh_score_stats(db, BID, TID, AlgoID, channel)
+    else:
+        set_score_stats(db, BID, TID, AlgoID, channel, min(previous["minScore"], min_score),
+                        max(previous["maxScore"], max_score))
+
+
+def refresh_score_stats(db: Database, BID: ObjectId, TID: ObjectId, AlgoID: ObjectId, channel: str):
+    stats = score_store.aggregate_stats(db, BID, {"TID": TID, "AlgoID": AlgoID, "channel": channel})
+    if len(stats) == 0:
+        db["scoreStats"].delete_one({"TID": TID, "AlgoID": AlgoID, "channel": channel})
+        update_score_baseline(db, BID, channel, AlgoID)
+    else:
+        set_score_stats(db, BID, TID, AlgoID, channel, stats[0]["minScore"], stats[0]["maxScore"])
+
+
+def rebuild_score_baselines(db: Database, BID: ObjectId):
+    db["scoreStats"].delete_many({"BID": BID})
+    db["scoreBaselines"].delete_many({"BID": BID})
+    stats = score_store.aggregate_stats(db, BID)
+    if len(stats) > 0:
+        db["scoreStats"].insert_many([
+            {"TID": s["_id"]["TID"], "AlgoID": s["_id"]["algorithm"], "channel": s["_id"]["channel"], "BID": BID,
+             "minScore": s["minScore"], "maxScore": s["maxScore"]} for s in stats
+        ])
+    for channel, AlgoID in {(s["_id"]["channel"], s["_id"]["algorithm"]) for s in stats}:
+        update_score_baseline(db, BID, channel, AlgoID)
+    caching.invalidate_baseline_min_max(str(BID))
+
+
+def verify_score_baselines(db: Database, BID: ObjectId):
+    # returns the (channel, algorithm) pairs whose materialized baseline differs from the scores
+    expected = {}
+    for s in score_store.aggregate_stats(db, BID):
+        key = (s["_id"]["channel"], s["_id"]["algorithm"])
+        low, high = expected.get(key, (math.inf, -math.inf))
+        expected[key] = (min(low, s["minScore"]), max(high, s["maxScore"]))
+    stored = {(b["channel"], b["AlgoID"]): (b["minScore"], b["maxScore"])
+              for b in db["scoreBaselines"].find({"BID": BID})}
+    return [key for key in set(expected) | set(stored) if expected.get(key) != stored.get(key)]
+
+
 def get_baseline_min_max(db: Database, BID: ObjectId):
-    pipeline = [
-        {
-            "$match": {
-                "ids.BID": BID
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "channel": "$channel",
-                    "algorithm": "$ids.AlgoID"
-                },
-                "minScore": {"$min": "$value"},
-                "maxScore": {"$max": "$value"}
-            }
-        }
+    # the materialized baseline is maintained on every score write and delete, the cache saves the round trip
+    cached = caching.get_baseline_min_max(str(BID))
+    if cached is not None:
+        return cached
+    baselines = list(db["scoreBaselines"].find({"BID": BID}))
+    if len(baselines) == 0 and score_store.has_scores(db, BID):
+        # scores written before the baseline was materialized
+        rebuild_score_baselines(db, BID)
+        baselines = list(db["scoreBaselines"].find({"BID": BID}))
+    aggregated_min_max = [
+        {"_id": {"channel": b["channel"], "algorithm": b["AlgoID"]}, "minScore": b["minScore"],
+         "maxScore": b["maxScore"]}
+        for b in baselines
     ]
-    aggregated_min_max = list(db["anomalyScores"].aggregate(pipeline))
+    caching.store_baseline_min_max(str(BID), aggregated_min_max)
     return aggregated_min_max
 
 
 def get_availble_score_algos(db: Database, TID: ObjectId):
-    pipeline = [
-        {
-            "$match": {
-                "ids.TID": TID
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "algorithm": "$ids.AlgoID"
-                },
-            }
-        }
-    ]
-    aggregated_min_max = list(db["anomalyScores"].aggregate(pipeline))
-    return aggregated_min_max
+    stats = score_store.aggregate_stats(db, get_timeseries(db, TID)["BID"], {"TID": TID})
+    return [{"_id": {"algorithm": AlgoID}} for AlgoID in {s["_id"]["algorithm"] for s in stats}]
 
 
 def query_timeseries(db: Database, TID: ObjectId, channel: str, from_: datetime.datetime = None,
-                     to_: datetime.datetime = None, n_segments: int | None = None, only_ts: bool = False):
-    return QueryTimeseries(db, TID=TID, from_=from_, to_=to_, n_segments=n_segments, channel=channel,
-                           only_ts=only_ts).exec()
+                     to_: datetime.datetime = None, n_segments: int | None = None, only_ts: bool = False,
+                     downsampling: str = None, columnar: bool = False):
+    query = QueryTimeseries(db, TID=TID, from_=from_, to_=to_, n_segments=n_segments, channel=channel,
+                            only_ts=only_ts, downsampling=downsampling)
+    return query.exec_columnar() if columnar else query.exec()
+
+
+def query_timeseries_windows(db: Database, TID: ObjectId, channel: str, windows: list, BID: ObjectId = None,
+                             metadata: dict = None):
+    # the same as query_timeseries(n_segments=None) for every (from_, to_) window, with a single read of the series
+    if len(windows) == 0:
+        return []
+    query = QueryTimeseries(db, TID=TID, channel=channel, BID=BID, n_segments=None, metadata=metadata,
+                            from_=min(lod.naive_utc(from_) for from_, _ in windows),
+                            to_=max(lod.naive_utc(to_) for _, to_ in windows))
+    return query.exec_windows(windows)
 
 
 def query_ts_list(db: Database, ts_list: List[str], channel: str, n_segments=None):
@@ -428,33 +714,19 @@ def query_ts_list_anomaly_scores(db: Database, ts_list: List[str], channel: str,
             "min": algo["minScore"],
             "max": algo["maxScore"]
         }
-    pipeline = [
-        {
-            "$match": {
-                "ids.TID": {"$in": ts_list_converted},
-                "channel": channel
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "AlgoID": "$ids.AlgoID",
-                    "TID": "$ids.TID"
-                },
-                "values": {"$push": f"$value"},
-            }
-        },
-    ]
-    all_scores = list(db["anomalyScores"].aggregate(pipeline))
-    if len(all_scores) == 0:
+    pieces = {}
+    for TID, AlgoID, timestamps, values in score_store.scan_scores(db, bucket_id, ts_list_converted, channel):
+        pieces.setdefault((AlgoID, TID), []).append((timestamps, values))
+    if len(pieces) == 0:
         return [], []
     scores_per_algo = {}
     score_indicator = {}
-    for score in all_scores:
-        index = score["_id"]["AlgoID"]
+    for (index, TID), series in pieces.items():
         if index not in score_indicator:
             score_indicator[index] = 0
-        values = np.array(score["values"])
+        # the pieces of a series arrive in arbitrary order
+        timestamps = np.concatenate([timestamps for timestamps, _ in series])
+        values = np.concatenate([values for _, values in series])[np.argsort(timestamps, kind="stable")]
         if n_segments is not None and n_segments > 2:
             values = TimeSeriesResampler(n_segments).fit_transform(values).flatten()
         if index not in scores_per_algo:
@@ -710,6 +982,24 @@ def delete_anomalies(db: Database, TID: ObjectId, delete_manual_anomalies: bool
     caching.invalidate_caches(str(ts["BID"]))
 
 
+def add_anomaly_ts_data(db: Database, anomalies: list, BID: ObjectId = None):
+    # the anomalies of a series and channel share one read, the bucket metadata is read once per bucket
+    series = {}
+    for anomaly in anomalies:
+        series.setdefault((anomaly["TID"], anomaly["channel"]), []).append(anomaly)
+    metadata = {}
+    for (ts_id, channel), group in series.items():
+        bucket_id = BID if BID is not None else get_timeseries(db, ts_id)["BID"]
+        if bucket_id not in metadata:
+            metadata[bucket_id] = bucket_metadata(db, bucket_id)
+        windows = [(anomaly["start"], anomaly["end"]) for anomaly in group]
+        ts_data = query_timeseries_windows(db, ts_id, channel, windows, bucket_id, metadata[bucket_id])
+        for anomaly, data in zip(group, ts_data):
+            anomaly["ts_data"] = data
+            for ts in anomaly["ts_data"]:
+                ts["timestamp_string"] = str(ts["timestamp"])
+
+
 def get_anomalies(db: Database, BID: ObjectId = None, TID: ObjectId = None, include_ts_data: bool = False,
                   only_marked: bool = False, only_manual: bool = False, only_bookmarked: bool = False):
     if BID is None and TID is None:
@@ -727,11 +1017,7 @@ def get_anomalies(db: Database, BID: ObjectId = None, TID: ObjectId = None, incl
         query["bookmark"] = True
     anomalies = list(db["anomalies"].find(query))
     if include_ts_data:
-        for anomaly in anomalies:
-            anomaly["ts_data"] = query_timeseries(db, anomaly["TID"], from_=anomaly["start"], to_=anomaly["end"],
-                                                  n_segments=None, channel=anomaly["channel"])
-            for ts in anomaly["ts_data"]:
-                ts["timestamp_string"] = str(ts["timestamp"])
+        add_anomaly_ts_data(db, anomalies, BID)
     if len(anomalies) == 0:
         return []
     scores = list(MinMaxScaler().fit_transform(np.array([a["score"] for a in anomalies]).reshape(-1, 1)))
@@ -744,6 +1030,11 @@ def get_anomalies(db: Database, BID: ObjectId = None, TID: ObjectId = None, incl
     return anomalies
 
 
+def get_anomaly_ids(db: Database, BID: ObjectId):
+    # in the order of get_anomalies
+    return [anomaly["_id"] for anomaly in db["anomalies"].find({"BID": BID}, {"_id": 1})]
+
+
 def get_anomaly(db: Database, AID: ObjectId, include_ts_data: bool = True, extension: float = 2):
     anomaly = db["anomalies"].find_one({"_id": ObjectId(AID)})
     anomaly["timeSeriesName"] = db["timeSeries"].find_one({"_id": anomaly["TID"]})["name"]
@@ -782,32 +1073,31 @@ def get_ratings(db: Database, BID: ObjectId):
     return {str(a["_id"]): a["rating"] for a in res}
 
 
+def threshold_runs(values: np.ndarray, threshold: float, min_length: int = 5):
+    # start (inclusive) and end (exclusive) of every run of at least min_length values >= threshold
+    above = np.concatenate([[False], np.asarray(values) >= threshold, [False]])
+    edges = np.flatnonzero(above[1:] != above[:-1])
+    starts, ends = edges[0::2], edges[1::2]
+    keep = ends - starts >= min_length
+    return starts[keep], ends[keep]
+
+
 def extract_anomalies_scoring(db: Database, TID: ObjectId, threshold: float):
     ts = get_timeseries(db, TID)
     found_anomalies = []
     for channel in ts["channels"]:
-        data = query_timeseries(db, TID, channel, n_segments=None)
-        start = None
-        anomaly_score = 0
-        length = 0
+        timestamps, _, scores, _, ensemble = QueryTimeseries(db, TID, channel, BID=ts["BID"], n_segments=None).compute()
+        if scores is None:
+            # nothing scored on this channel yet
+            continue
         base = {"TID": TID, "BID": ts["BID"], "channel": channel, "keep": False, "bookmark": False, "manual": False,
                 "rating": 0, "views": 0}
-        for i, data_point in enumerate(data):
-            if data_point["ensemble_processed"] >= threshold:
-                if start is None:
-                    start = data_point["timestamp"]
-                anomaly_score += data_point["ensemble_processed"]
-                length += 1
-            elif start is not None:
-                if length >= 5:
-                    found_anomalies.append({"start": start, "end": data[i - 1]["timestamp"], "length": length,
-                                            "score": anomaly_score / length, **base})
-                start = None
-                anomaly_score = 0
-                length = 0
-        if start is not None and length >= 5:
-            found_anomalies.append({"start": start, "end": data[len(data) - 1]["timestamp"], "length": length,
-                                    "score": anomaly_score / length, **base})
+        starts, ends = threshold_runs(ensemble, threshold)
+        sums = np.concatenate([[0], np.cumsum(ensemble)])
+        for start, end in zip(starts, ends):
+            length = int(end - start)
+            found_anomalies.append({"start": timestamps[start], "end": timestamps[end - 1], "length": length,
+                                    "score": float((sums[end] - sums[start]) / length), **base})
     return found_anomalies
 
 
@@ -987,24 +1277,29 @@ def reset_ratings(db: Database, TID: ObjectId):
 
 
 def find_similar_bookmark(db: Database, BID: ObjectId, AID: ObjectId, max_distance: float = 0.3,
-                          length_tolerance: float = 0.1):
+                          length_tolerance: float = 0.1, candidates: int = similarity.CANDIDATES):
+    # the nearest bookmarks by embedding are compared with DTW, bookmarks outside of these candidates are not checked
     anomaly = get_anomaly(db, AID, include_ts_data=True, extension=0)
     channel = anomaly["channel"]
-    anomaly_values = np.array([m["value"] for m in anomaly["ts_data"]])
-    anomaly_values = MinMaxScaler().fit_transform(anomaly_values.reshape(-1, 1)).reshape(1, -1)[0]
-    bookmark_anomalies = get_anomalies(db, BID, None, True, False, False, True)
+    anomaly_values = similarity.normalize(np.array([m["value"] for m in anomaly["ts_data"]]))
+    # a bookmarked anomaly stays in the index of its bucket and channel, nearest skips it as a result
+    bookmarks = [bookmark for bookmark in get_anomalies(db, BID, only_bookmarked=True) if bookmark["channel"] == channel]
+    shapes = similarity.bucket_shapes(BID)
+    missing = [bookmark for bookmark in bookmarks if bookmark["_id"] not in shapes]
+    add_anomaly_ts_data(db, missing, BID)
+    for bookmark in missing:
+        similarity.add_shape(BID, bookmark["_id"], np.array([m["value"] for m in bookmark["ts_data"]]))
+    bookmarks = {bookmark["_id"]: bookmark for bookmark in bookmarks}
     similar = []
-    for bookmark in bookmark_anomalies:
-        if bookmark["channel"] != channel:
-            continue
-        bookmark_values = np.array([m["values"][channel] for m in bookmark["ts_data"]])
+    for bookmark_id in similarity.nearest(BID, channel, list(bookmarks), anomaly_values, candidates, length_tolerance,
+                                          anomaly["_id"]):
+        bookmark_values = shapes[bookmark_id][0]
         avg_length = (len(bookmark_values) + len(anomaly_values)) / 2
-        if abs(len(anomaly_values) - len(bookmark_values)) / avg_length > length_tolerance:
-            continue
-        bookmark_values = MinMaxScaler().fit_transform(bookmark_values.reshape(-1, 1)).reshape(1, -1)[0]
-        sim = fastdtw(bookmark_values, anomaly_values, dist=2)[0]
+        sim = similarity.dtw_distance(bookmark_values, anomaly_values)
         if sim < avg_length * max_distance:
-            similar.append((sim, bookmark))
+            similar.append((sim, bookmarks[bookmark_id]))
+    similar.sort(key=lambda item: item[0])
+    add_anomaly_ts_data(db, [bookmark for _, bookmark in similar if "ts_data" not in bookmark], BID)
     return similar
 
 
@@ -1063,12 +1358,13 @@ def dissimilar_recommender(db: Database, BID: ObjectId, k=3, only_unrated=True):
     scores = np.sum(scores, axis=1)
     id_scores = sorted([(i, a["_id"], score) for i, a, score in zip(range(len(anomalies)), anomalies, scores)],
                        key=lambda x: x[2], reverse=True)
+    # rows of the memory-mapped distances are read one at a time
     dtw_matrix = clustering.dtw_matrix(str(BID))
-    length_matrix = np.array([[abs(a["length"] - b["length"]) for b in anomalies] for a in anomalies])
+    lengths = np.array([a["length"] for a in anomalies])
     ranking = []
     for item in id_scores:
         dtw_values = MinMaxScaler().fit_transform(dtw_matrix[item[0], :].reshape(-1, 1))[:, 0]
-        length_values = MinMaxScaler().fit_transform(length_matrix[item[0], :].reshape(-1, 1))[:, 0]
+        length_values = MinMaxScaler().fit_transform(np.abs(lengths - lengths[item[0]]).reshape(-1, 1))[:, 0]
         item_scores = sorted([(a, score) for a, score in zip(anomalies, dtw_values + (1 - length_values))],
                              key=lambda x: x[1], reverse=True)
         if only_unrated:
@@ -1078,18 +1374,23 @@ def dissimilar_recommender(db: Database, BID: ObjectId, k=3, only_unrated=True):
 
 
 def collab_filtering(db: Database, BID: ObjectId, k=5):
-    def estimate_rating(i, dtw, ratings):
-        k_nearest = np.argpartition(dtw[i, :], -k)[-k:]
-        summed_similarities = np.sum(np.abs(dtw[i, k_nearest]))
-        sum_ = np.sum([dtw[i, j] * ratings[j] for j in k_nearest])
+    def estimate_rating(i, similarities, ratings):
+        k_nearest = np.argpartition(similarities, -k)[-k:]
+        summed_similarities = np.sum(np.abs(similarities[k_nearest]))
+        sum_ = np.sum([similarities[j] * ratings[j] for j in k_nearest])
         return sum_ / summed_similarities
 
+    # similarities are the min-max scaled columns of the distances, the matrix is symmetric so the range of a column is
+    # the range of its row and each row can be scaled on its own without loading the whole matrix
     dtw_matrix = clustering.dtw_matrix(str(BID))
-    dtw_matrix = 1 - MinMaxScaler().fit_transform(dtw_matrix)
+    minimum = np.array([np.min(row) for row in dtw_matrix], dtype=float)
+    maximum = np.array([np.max(row) for row in dtw_matrix], dtype=float)
+    scale = np.where(maximum > minimum, maximum - minimum, 1)
     anomalies = get_anomalies(db, BID)
     ratings = np.array([a["rating"] for a in anomalies])
     ratings = [(r + 5) / 10 for r in ratings]
-    estimated_ratings = np.array([estimate_rating(i, dtw_matrix, ratings) for i in range(len(anomalies))])
+    estimated_ratings = np.array([estimate_rating(i, 1 - (dtw_matrix[i] - minimum) / scale, ratings)
+                                  for i in range(len(anomalies))])
     estimated_ratings = MinMaxScaler().fit_transform(estimated_ratings.reshape(-1, 1))[:, 0]
     items = [(float(r), a["_id"]) for r, a in zip(estimated_ratings, anomalies)]
     return sorted(items, key=lambda x: x[0], reverse=True)
@@ -0,0 +1,53 @@
+import json
+import time
+
+import numpy as np
+from bson import ObjectId, json_util
+from flask.json.provider import DefaultJSONProvider
+
+
+def mongodb_default(o):
+    # numpy values are converted directly, everything else gets bson's extended JSON ($oid, $date, ...)
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    if isinstance(o, np.generic):
+        return o.item()
+    return json_util.default(o)
+
+
+def dumps_mongodb(output):
+    return json.dumps(output, default=mongodb_default)
+
+
+class JSONProvider(DefaultJSONProvider):
+    # used for responses returned as plain dicts and lists, datetimes keep flask's http date format
+    sort_keys = False
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        if isinstance(o, np.generic):
+            return o.item()
+        if isinstance(o, ObjectId):
+            return json_util.default(o)
+        return DefaultJSONProvider.default(o)
+
+
+if __name__ == '__main__':
+    import flask
+    import backend.helper.database as database
+
+    # serialization cost of /api/anomalies/bucket/<BID>?include_ts_data=true, before and after
+    db = database.get_db()
+    app = flask.Flask(__name__)
+    BID = database.list_buckets(db)[0]["_id"]
+    anomalies = database.get_anomalies(db, BID=BID, include_ts_data=True)
+    with app.app_context():
+        start = time.time()
+        round_trip = flask.json.dumps(json.loads(json.dumps(anomalies, default=json_util.default)))
+        print(f"dumps + loads + flask dumps: {time.time() - start:.3f}s")
+        start = time.time()
+        direct = dumps_mongodb(anomalies)
+        print(f"direct: {time.time() - start:.3f}s")
+        print("identical:", json.loads(round_trip) == json.loads(direct))
@@ -0,0 +1,226 @@
+import datetime
+import math
+
+import numpy as np
+from bson import ObjectId
+from pymongo import ReplaceOne
+from pymongo.database import Database
+
+from backend.helper.config import get_config
+
+conf = get_config()
+MIN_LEVEL = conf["lod"]["min_level"]
+CHUNK_SIZE = conf["lod"]["chunk_size"]
+FIELDS = ["timestamp", "min", "max", "sum", "count"]
+
+# Level L of a pyramid aggregates 2^L consecutive points into one entry (min, max, mean and count). Levels start at
+# MIN_LEVEL, finer windows are read from the raw data. Every level is stored in documents of CHUNK_SIZE entries in
+# lodTiles, the per series bookkeeping (rows, time range and entries per level) lives in lodSeries. Raw values use
+# AlgoID None, anomaly scores the AlgoID of their algorithm.
+
+
+def series_key(TID: ObjectId, channel: str, AlgoID: ObjectId = None):
+    return {"TID": TID, "channel": channel, "AlgoID": AlgoID}
+
+
+def naive_utc(timestamp: datetime.datetime | None):
+    # mongo returns naive utc datetimes in millisecond precision, parsed timestamps may carry a timezone or microseconds
+    if timestamp is None:
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+
+
+def make_entries(timestamps: list, values: np.ndarray):
+    values = np.asarray(values, dtype=np.float64)
+    timestamp_array = np.empty(len(timestamps), dtype=object)
+    timestamp_array[:] = [naive_utc(timestamp) for timestamp in timestamps]
+    return {"timestamp": timestamp_array, "min": values, "max": values, "sum": values,
+            "count": np.ones(len(values), dtype=np.int64)}
+
+
+def group_entries(entries: dict, size: int):
+    # merges every size consecutive entries into one, the last group may be partial
+    starts = np.arange(0, len(entries["count"]), size)
+    if len(starts) == 0:
+        return entries
+    return {
+        "timestamp": entries["timestamp"][starts],
+        "min": np.minimum.reduceat(entries["min"], starts),
+        "max": np.maximum.reduceat(entries["max"], starts),
+        "sum": np.add.reduceat(entries["sum"], starts),
+        "count": np.add.reduceat(entries["count"], starts),
+    }
+
+
+def concat_entries(*parts: dict):
+    return {field: np.concatenate([part[field] for part in parts]) for field in FIELDS}
+
+
+def slice_entries(entries: dict, start: int, end: int = None):
+    return {field: entries[field][start:end] for field in FIELDS}
+
+
+def entries_to_document(entries: dict):
+    return {
+        "start": entries["timestamp"][0],
+        "end": entries["timestamp"][-1],
+        "timestamp": entries["timestamp"].tolist(),
+        "min": entries["min"].tolist(),
+        "max": entries["max"].tolist(),
+        "mean": (entries["sum"] / entries["count"]).tolist(),
+        "count": entries["count"].tolist(),
+    }
+
+
+def document_to_entries(document: dict):
+    timestamps = np.empty(len(document["timestamp"]), dtype=object)
+    timestamps[:] = document["timestamp"]
+    count = np.array(document["count"], dtype=np.int64)
+    return {
+        "timestamp": timestamps,
+        "min": np.array(document["min"], dtype=np.float64),
+        "max": np.array(document["max"], dtype=np.float64),
+        "sum": np.array(document["mean"], dtype=np.float64) * count,
+        "count": count,
+    }
+
+
+def read_entry(db: Database, key: dict, level: int, index: int):
+    document = db["lodTiles"].find_one({**key, "level": level, "chunk": index // CHUNK_SIZE})
+    position = index % CHUNK_SIZE
+    return slice_entries(document_to_entries(document), position, position + 1)
+
+
+def write_level(db: Database, BID: ObjectId, key: dict, level: int, start: int, entries: dict):
+    # replaces the entries of a level from index start on, the entries before it are kept
+    first_chunk = start // CHUNK_SIZE
+    if start % CHUNK_SIZE != 0:
+        document = db["lodTiles"].find_one({**key, "level": level, "chunk": first_chunk})
+        entries = concat_entries(slice_entries(document_to_entries(document), 0, start % CHUNK_SIZE), entries)
+    operations = []
+    for offset in range(0, len(entries["count"]), CHUNK_SIZE):
+        chunk = first_chunk + offset // CHUNK_SIZE
+        document = {**key, "BID": BID, "level": level, "chunk": chunk,
+                    **entries_to_document(slice_entries(entries, offset, offset + CHUNK_SIZE))}
+        operations.append(ReplaceOne({**key, "level": level, "chunk": chunk}, document, upsert=True))
+    if len(operations) > 0:
+        db["lodTiles"].bulk_write(operations, ordered=False)
+
+
+def delete_pyramids(db: Database, query: dict):
+    db["lodTiles"].delete_many(query)
+    db["lodSeries"].delete_many(query)
+
+
+def get_pyramid(db: Database, TID: ObjectId, channel: str, AlgoID: ObjectId = None):
+    return db["lodSeries"].find_one(series_key(TID, channel, AlgoID))
+
+
+def build_pyramid(db: Database, BID: ObjectId, TID: ObjectId, channel: str, AlgoID: ObjectId, timestamps: list,
+                  values: np.ndarray):
+    key = series_key(TID, channel, AlgoID)
+    delete_pyramids(db, key)
+    if len(values) == 0:
+        return
+    points = make_entries(timestamps, values)
+    entries = group_entries(points, 2 ** MIN_LEVEL)
+    lengths = []
+    while True:
+        write_level(db, BID, key, MIN_LEVEL + len(lengths), 0, entries)
+        lengths.append(len(entries["count"]))
+        if len(entries["count"]) <= 1:
+            break
+        entries = group_entries(entries, 2)
+    db["lodSeries"].insert_one({**key, "BID": BID, "rows": len(values), "first_timestamp": points["timestamp"][0],
+                                "last_timestamp": points["timestamp"][-1], "lengths": lengths})
+
+
+def extend_pyramid(db: Database, BID: ObjectId, TID: ObjectId, channel: str, AlgoID: ObjectId, timestamps: list,
+                   values: np.ndarray):
+    # only points after the end of the pyramid can be added, otherwise the caller has to rebuild it
+    key = series_key(TID, channel, AlgoID)
+    meta = db["lodSeries"].find_one(key)
+    if meta is None or len(values) == 0:
+        return False
+    new_entries = make_entries(timestamps, values)
+    if new_entries["timestamp"][0] <= meta["last_timestamp"]:
+        return False
+    group_size = 2 ** MIN_LEVEL
+    start, filled = divmod(meta["rows"], group_size)
+    if filled > 0:
+        # the last entry of the first level is incomplete, it is merged with the first new points
+        head = group_entries(slice_entries(new_entries, 0, group_size - filled), group_size)
+        merged = group_entries(concat_entries(read_entry(db, key, MIN_LEVEL, start), head), 2)
+        changed = concat_entries(merged, group_entries(slice_entries(new_entries, group_size - filled), group_size))
+    else:
+        changed = group_entries(new_entries, group_size)
+    lengths = list(meta["lengths"])
+    level = MIN_LEVEL
+    while True:
+        write_level(db, BID, key, level, start, changed)
+        length = start + len(changed["count"])
+        if level - MIN_LEVEL < len(lengths):
+            lengths[level - MIN_LEVEL] = length
+        else:
+            lengths.append(length)
+        if length <= 1:
+            break
+        # the next level recomputes every pair that contains a changed entry
+        if start % 2 == 1:
+            changed = concat_entries(read_entry(db, key, level, start - 1), changed)
+            start -= 1
+        changed = group_entries(changed, 2)
+        start //= 2
+        level += 1
+    db["lodSeries"].update_one(key, {"$set": {"rows": meta["rows"] + len(values),
+                                              "last_timestamp": new_entries["timestamp"][-1], "lengths": lengths}})
+    return True
+
+
+def select_level(meta: dict, from_: datetime.datetime | None, to_: datetime.datetime | None, n_segments: int):
+    # estimates the points in the window assuming an even sampling rate and picks the coarsest level that still
+    # yields n_segments entries, None means the window is small enough to be read raw
+    first, last = meta["first_timestamp"], meta["last_timestamp"]
+    start = max(first, from_) if from_ is not None else first
+    end = min(last, to_) if to_ is not None else last
+    if end < start:
+        return None
+    fraction = (end - start) / (last - first) if last > first else 1
+    points = meta["rows"] * fraction
+    if points < n_segments * 2 ** MIN_LEVEL:
+        return None
+    return min(int(math.log2(points / n_segments)), MIN_LEVEL + len(meta["lengths"]) - 1)
+
+
+def read_level(db: Database, key: dict, level: int, from_: datetime.datetime | None, to_: datetime.datetime | None):
+    query = {**key, "level": level}
+    if from_ is not None:
+        query["end"] = {"$gte": from_}
+    if to_ is not None:
+        query["start"] = {"$lte": to_}
+    documents = list(db["lodTiles"].find(query).sort("chunk", 1))
+    if len(documents) == 0:
+        return None
+    entries = concat_entries(*[document_to_entries(document) for document in documents])
+    mask = np.ones(len(entries["count"]), dtype=bool)
+    if from_ is not None:
+        mask &= entries["timestamp"] >= from_
+    if to_ is not None:
+        mask &= entries["timestamp"] <= to_
+    return {field: entries[field][mask] for field in FIELDS}
+
+
+def read_window(db: Database, meta: dict, from_: datetime.datetime | None, to_: datetime.datetime | None,
+                n_segments: int):
+    # returns the level and its entries in the window, steps to finer levels if the estimate was too optimistic
+    from_, to_ = naive_utc(from_), naive_utc(to_)
+    key = series_key(meta["TID"], meta["channel"], meta["AlgoID"])
+    level = select_level(meta, from_, to_, n_segments)
+    while level is not None and level >= MIN_LEVEL:
+        entries = read_level(db, key, level, from_, to_)
+        if entries is not None and len(entries["count"]) >= n_segments:
+            return level, entries
+        level -= 1
+    return None, None
@@ -1,4 +1,6 @@
 import datetime
+import json
+import math
 import time
 from pprint import pprint
 
@@ -11,10 +13,31 @@ from tslearn.piecewise import PiecewiseAggregateApproximation
 from tslearn.preprocessing import TimeSeriesResampler
 
 import backend.helper.database as database
+import backend.helper.lod as lod
+import backend.helper.score_store as score_store
+from backend.helper.config import get_config
+
+conf = get_config()
+# "python" reads every raw point in the window and resamples it, "lod" reads the coarsest sufficient pyramid level,
+# "database" averages n_segments equally long time bins inside the aggregation pipeline and "minmax" keeps the lowest
+# and the highest point of n_segments / 2 bins there, so spikes survive the downsampling
+DOWNSAMPLING_MODES = ["python", "lod", "database", "minmax"]
+# "rows" returns one dict per point, "columnar" one array per field
+RESPONSE_FORMATS = ["rows", "columnar"]
+COLUMNAR_MIMETYPE = "application/vnd.anoscout.columnar+json"
+
+
+def bucket_metadata(db: Database, BID: ObjectId):
+    # everything a query needs from the bucket, shared by queries of many series of the same bucket
+    return {
+        "bucket": database.get_bucket(db, BID),
+        "baseline": database.get_baseline_min_max(db, BID),
+        "algorithms": database.get_bucket_algorithms(db, BID),
+    }
 
 
 class QueryTimeseries:
-    def __init__(self, db: Database, TID: ObjectId, channel: str, BID: ObjectId = None, from_: datetime.datetime = None, to_: datetime.datetime = None, n_segments: int | None = 1000, only_ts: bool = False):
+    def __init__(self, db: Database, TID: ObjectId, channel: str, BID: ObjectId = None, from_: datetime.datetime = None, to_: datetime.datetime = None, n_segments: int | None = 1000, only_ts: bool = False, downsampling: str = None, metadata: dict = None):
         self.data_points = []
         self.db = db
         self.TID = TID
@@ -24,57 +47,172 @@ class QueryTimeseries:
         self.n_segments = n_segments
         self.channel = channel
         self.only_ts = only_ts
+        self.downsampling = downsampling if downsampling is not None else conf["query"]["downsampling"]
+        if self.downsampling not in DOWNSAMPLING_MODES:
+            raise ValueError(f"downsampling must be one of {', '.join(DOWNSAMPLING_MODES)}")
 
-        self.bucket = database.get_bucket(db, self.BID)
+        metadata = metadata if metadata is not None else bucket_metadata(db, self.BID)
+        self.bucket = metadata["bucket"]
         self.smoothing_window = self.bucket["smoothing_window"]
         self.threshold = self.bucket["threshold"]
 
-        algorithms = database.get_bucket_algorithms(db, self.BID)
-        self.min_max = database.get_baseline_min_max(db, self.BID)
-        self.available_scores = [a["_id"]["algorithm"] for a in database.get_availble_score_algos(db, self.TID)]
-        self.algorithms = []
-
-        for scoring in self.min_max:
-            for algo in algorithms:
-                if scoring["_id"]["algorithm"] == algo["_id"] and scoring["_id"]["algorithm"] in self.available_scores:
-                    self.algorithms.append(algo)
+        # baseline of every algorithm scored on this channel, algorithms without scores for this series are dropped
+        # once the scores are queried
+        self.baseline = {
+            b["_id"]["algorithm"]: b for b in metadata["baseline"] if b["_id"]["channel"] == channel
+        }
+        self.algorithms = [a for a in metadata["algorithms"] if a["_id"] in self.baseline]
 
     def get_db_filter(self, collection: str):
-        if collection not in ["timeSeriesData", "anomalyScores"]:
+        if collection not in ["timeSeriesData"]:
             raise Exception("unsupported collection")
 
         db_filter = {"ids.TID": self.TID}
-        if collection == "anomalyScores":
-            db_filter["channel"] = self.channel
         if self.from_ is not None or self.to_ is not None:
             db_filter["timestamp"] = {}
             if self.from_ is not None:
                 db_filter["timestamp"]["$gte"] = self.from_
             if self.to_ is not None:
                 db_filter["timestamp"]["$lte"] = self.to_
-        select = {"_id": 0, "timestamp": 1}
-        if collection == "timeSeriesData":
-            select[f"values.{self.channel}"] = 1
-        else:
-            select["value"] = 1
+        select = {"_id": 0, "timestamp": 1, f"values.{self.channel}": 1}
 
         return db_filter, select
 
     def time_series_query(self):
         db_filter, select = self.get_db_filter("timeSeriesData")
-        ts = list(self.db["timeSeriesData"].find(db_filter, select))
+        ts = list(self.db["timeSeriesData"].find(db_filter, select).sort("timestamp", 1))
         timestamps = [t["timestamp"] for t in ts]
         values = [t["values"][self.channel] for t in ts]
         return timestamps, np.array(values)
 
-    def anomaly_score_query(self):
-        db_filter, select = self.get_db_filter("anomalyScores")
+    def anomaly_score_query(self, timestamps: list):
+        return self.fill_missing_scores(self.score_matrix(timestamps))
+
+    def score_matrix(self, timestamps: list):
+        # one read for all algorithms, every score is scattered onto the position of its timestamp
+        positions = np.array(timestamps, dtype="datetime64[ms]")
+        algo_index = {algo["_id"]: index for index, algo in enumerate(self.algorithms)}
+        scores = np.full((len(self.algorithms), len(timestamps)), np.nan)
+        pieces = score_store.scan_scores(self.db, self.BID, [self.TID], self.channel, list(algo_index),
+                                         self.from_, self.to_)
+        for _, algo_id, piece_timestamps, values in pieces:
+            columns = np.minimum(np.searchsorted(positions, piece_timestamps), max(len(positions) - 1, 0))
+            matches = positions[columns] == piece_timestamps if len(positions) > 0 else np.zeros(len(values), bool)
+            scores[algo_index[algo_id], columns[matches]] = values[matches]
+        return scores
+
+    def fill_missing_scores(self, scores: np.ndarray):
+        available = ~np.all(np.isnan(scores), axis=1)
+        self.algorithms = [algo for algo, keep in zip(self.algorithms, available) if keep]
+        scores = scores[available]
+        # timestamps that one algorithm has not scored yet take the neighbouring scores
+        for row in scores:
+            missing = np.isnan(row)
+            if np.any(missing):
+                row[missing] = np.interp(np.flatnonzero(missing), np.flatnonzero(~missing), row[~missing])
+        return scores
+
+    def lod_query(self):
+        # returns None whenever a pyramid is missing or lags behind the data, the caller then reads the raw points
+        if self.n_segments is None:
+            return None
+        pyramid = lod.get_pyramid(self.db, self.TID, self.channel)
+        last = self.db["timeSeriesData"].find_one({"ids.TID": self.TID}, {"timestamp": 1},
+                                                  sort=[("timestamp", -1)])
+        if pyramid is None or last is None or pyramid["last_timestamp"] != last["timestamp"]:
+            return None
+        level, entries = lod.read_window(self.db, pyramid, self.from_, self.to_, self.n_segments)
+        if level is None:
+            return None
+        timestamps = entries["timestamp"].tolist()
+        values = entries["sum"] / entries["count"]
+        if len(self.algorithms) == 0 or self.only_ts:
+            return timestamps, values, None
         scores = []
+        algorithms = []
         for algo in self.algorithms:
-            db_filter_algo = {**db_filter, "ids.AlgoID": algo["_id"]}
-            algo_scores = list(self.db["anomalyScores"].find(db_filter_algo, select))
-            scores.append([s["value"] for s in algo_scores])
-        return np.array(scores)
+            score_pyramid = lod.get_pyramid(self.db, self.TID, self.channel, algo["_id"])
+            if score_pyramid is None:
+                # an algorithm without any scores for this series is simply left out
+                if not score_store.has_scores(self.db, self.BID,
+                                              {"TID": self.TID, "channel": self.channel, "AlgoID": algo["_id"]}):
+                    continue
+                return None
+            if score_pyramid["rows"] != pyramid["rows"]:
+                return None
+            score_entries = lod.read_level(self.db, lod.series_key(self.TID, self.channel, algo["_id"]), level,
+                                           lod.naive_utc(self.from_), lod.naive_utc(self.to_))
+            if score_entries is None or len(score_entries["count"]) != len(timestamps):
+                return None
+            scores.append(score_entries["sum"] / score_entries["count"])
+            algorithms.append(algo)
+        self.algorithms = algorithms
+        return timestamps, values, np.array(scores) if len(algorithms) > 0 else None
+
+    def time_bins(self, db_filter: dict, n_bins: int):
+        # returns the start and the size in milliseconds of the n_bins bins that cover the window
+        start = lod.naive_utc(self.from_)
+        end = lod.naive_utc(self.to_)
+        if start is None:
+            first = self.db["timeSeriesData"].find_one(db_filter, {"timestamp": 1}, sort=[("timestamp", 1)])
+            start = first["timestamp"] if first is not None else None
+        if end is None:
+            last = self.db["timeSeriesData"].find_one(db_filter, {"timestamp": 1}, sort=[("timestamp", -1)])
+            end = last["timestamp"] if last is not None else None
+        if start is None or end is None:
+            return None
+        # the window is inclusive on both ends, so the last point must still fall into bin n_bins - 1
+        bin_size = max(1, math.ceil(((end - start).total_seconds() * 1000 + 1) / n_bins))
+        return start, bin_size
+
+    def database_query(self, extremes: bool = False):
+        if self.n_segments is None:
+            return None
+        db_filter, _ = self.get_db_filter("timeSeriesData")
+        # two points per bin keep the extremes within n_segments, process would resample anything longer
+        bins = self.time_bins(db_filter, max(1, self.n_segments // 2) if extremes else self.n_segments)
+        if bins is None:
+            return None
+        start, bin_size = bins
+        # index of the bin a document falls into, subtracting two dates yields milliseconds
+        time_bin = {"$floor": {"$divide": [{"$subtract": ["$timestamp", start]}, bin_size]}}
+        if extremes:
+            point = {"timestamp": "$timestamp", "value": f"$values.{self.channel}"}
+            pipeline = [
+                {"$match": {**db_filter, f"values.{self.channel}": {"$ne": None}}},
+                {"$group": {"_id": time_bin,
+                            "low": {"$top": {"sortBy": {f"values.{self.channel}": 1}, "output": point}},
+                            "high": {"$top": {"sortBy": {f"values.{self.channel}": -1}, "output": point}}}},
+                {"$sort": {"_id": 1}}
+            ]
+            binned_values = []
+            for b in self.db["timeSeriesData"].aggregate(pipeline):
+                # both extremes in their order in time, a bin with a single distinct point yields it once
+                points = sorted([b["low"], b["high"]], key=lambda p: p["timestamp"])
+                if points[0]["timestamp"] == points[1]["timestamp"]:
+                    points = points[:1]
+                binned_values += [{"_id": b["_id"], **p} for p in points]
+        else:
+            pipeline = [
+                {"$match": db_filter},
+                {"$group": {"_id": time_bin, "timestamp": {"$min": "$timestamp"},
+                            "value": {"$avg": f"$values.{self.channel}"}}},
+                {"$sort": {"_id": 1}}
+            ]
+            binned_values = list(self.db["timeSeriesData"].aggregate(pipeline))
+        bins = np.array([b["_id"] for b in binned_values], dtype=np.float64)
+        timestamps = [b["timestamp"] for b in binned_values]
+        values = np.array([b["value"] for b in binned_values], dtype=np.float64)
+        if len(self.algorithms) == 0 or self.only_ts:
+            return timestamps, values, None
+        # the highest score of a bin next to its extremes, a short anomaly would vanish in the mean
+        binned_scores = score_store.bin_scores(self.db, self.BID, self.TID, self.channel,
+                                               [algo["_id"] for algo in self.algorithms], self.from_, self.to_,
+                                               start, bin_size, "$max" if extremes else "$avg")
+        self.algorithms = [algo for algo in self.algorithms if len(binned_scores[algo["_id"]][0]) > 0]
+        # bins without scores (e.g. a tail that is not scored yet) take the neighbouring values
+        scores = [np.interp(bins, *binned_scores[algo["_id"]]) for algo in self.algorithms]
+        return timestamps, values, np.array(scores) if len(self.algorithms) > 0 else None
 
     def reduce(self, values: np.array) -> (np.array):
         n = values.shape[0] if values.ndim == 1 else values.shape[1]
@@ -90,8 +228,9 @@ class QueryTimeseries:
 
     def normalize(self, scores: np.array) -> np.array:
         scores_norm = []
-        for index, algo_score in enumerate(scores):
-            scores_norm.append((algo_score - self.min_max[index]["minScore"]) / (self.min_max[index]["maxScore"] - self.min_max[index]["minScore"]))
+        for algo, algo_score in zip(self.algorithms, scores):
+            baseline = self.baseline[algo["_id"]]
+            scores_norm.append((algo_score - baseline["minScore"]) / (baseline["maxScore"] - baseline["minScore"]))
         return np.array(scores_norm)
 
     def reduce_timestamps(self, timestamps):
@@ -117,12 +256,41 @@ class QueryTimeseries:
                 pass
         return ensemble_post
 
-    def exec(self):
-        timestamps, ts_data = self.time_series_query()
+    def fetch(self):
+        downsampled = None
+        if self.downsampling == "lod":
+            downsampled = self.lod_query()
+        elif self.downsampling == "database":
+            downsampled = self.database_query()
+        elif self.downsampling == "minmax":
+            downsampled = self.database_query(extremes=True)
+        if downsampled is not None:
+            timestamps, ts_data, scores = downsampled
+        else:
+            timestamps, ts_data = self.time_series_query()
+            scores = None
+        if scores is None and len(self.algorithms) > 0 and not self.only_ts:
+            scores = self.anomaly_score_query(timestamps)
+        return timestamps, ts_data, scores
+
+    def process(self, timestamps: list, ts_data: np.ndarray, scores: np.ndarray | None):
         ts_data = self.reduce(ts_data)
         timestamps = self.reduce_timestamps(timestamps)
 
         if len(self.algorithms) == 0 or self.only_ts:
+            return timestamps, ts_data, None, None, None
+
+        scores = self.reduce(scores)
+        scores_norm = self.normalize(scores)
+        en = self.ensemble(scores_norm)
+        en2 = self.post_process_ensemble(en)
+        return timestamps, ts_data, scores_norm, en, en2
+
+    def compute(self):
+        return self.process(*self.fetch())
+
+    def rows(self, timestamps: list, ts_data: np.ndarray, scores_norm: np.ndarray | None, en, en2):
+        if scores_norm is None:
             result = []
             for index in range(len(timestamps)):
                 result.append({
@@ -131,11 +299,6 @@ class QueryTimeseries:
                 })
             return result
 
-        scores = self.anomaly_score_query()
-        scores = self.reduce(scores)
-        scores_norm = self.normalize(scores)
-        en = self.ensemble(scores_norm)
-        en2 = self.post_process_ensemble(en)
         result = []
         for index in range(len(timestamps)):
             algo_scores = {str(a["_id"]): scores_norm[i][index] for i, a in enumerate(self.algorithms)}
@@ -148,9 +311,52 @@ class QueryTimeseries:
             })
         return result
 
+    def exec(self):
+        return self.rows(*self.compute())
+
+    def exec_windows(self, windows: list):
+        # reads the raw points and scores in from_/to_ once and returns what exec would return for every
+        # (from_, to_) window inside of it, the windows run through the same steps in memory
+        timestamps, ts_data = self.time_series_query()
+        algorithms = self.algorithms
+        matrix = self.score_matrix(timestamps) if len(algorithms) > 0 and not self.only_ts else None
+        positions = np.array(timestamps, dtype="datetime64[ms]")
+        results = []
+        for from_, to_ in windows:
+            start = np.searchsorted(positions, np.datetime64(lod.naive_utc(from_), "ms"), side="left")
+            end = np.searchsorted(positions, np.datetime64(lod.naive_utc(to_), "ms"), side="right")
+            self.algorithms = algorithms
+            scores = self.fill_missing_scores(matrix[:, start:end].copy()) if matrix is not None else None
+            results.append(self.rows(*self.process(timestamps[start:end], ts_data[start:end], scores)))
+        self.algorithms = algorithms
+        return results
+
+    def exec_columnar(self):
+        # the same data as exec as parallel arrays, timestamps are milliseconds since the epoch (UTC)
+        timestamps, ts_data, scores_norm, en, en2 = self.compute()
+        result = {
+            "timestamp": np.array(timestamps, dtype="datetime64[ms]").astype(np.int64).tolist(),
+            "value": np.asarray(ts_data, dtype=np.float64).tolist(),
+        }
+        if scores_norm is None:
+            return result
+        result["scores"] = {str(a["_id"]): scores_norm[i].tolist() for i, a in enumerate(self.algorithms)}
+        result["ensemble"] = np.asarray(en).tolist()
+        result["ensemble_processed"] = np.asarray(en2).tolist()
+        return result
 
 if __name__ == '__main__':
     db = database.get_db()
     TID = ObjectId("67925c8cfc8d0657099ad5fc")
     query = QueryTimeseries(db, TID, "value-0", n_segments=30).exec()
     print(query)
+    for mode in DOWNSAMPLING_MODES:
+        start = time.time()
+        QueryTimeseries(db, TID, "value-0", n_segments=1000, downsampling=mode).exec()
+        print(f"{mode}: {time.time() - start:.3f}s")
+    for response_format in RESPONSE_FORMATS:
+        query = QueryTimeseries(db, TID, "value-0", n_segments=None)
+        start = time.time()
+        result = query.exec_columnar() if response_format == "columnar" else query.exec()
+        payload = json.dumps(result, default=str)
+        print(f"{response_format}: {time.time() - start:.3f}s, {len(payload) / 1e6:.2f} MB")
@@ -1,23 +1,84 @@
+import hashlib
 import json
+import os
+import socket
+from datetime import datetime
 
 import redis
-from bson import ObjectId
-from pymongo.database import Database
 
 from backend.helper.config import get_redis_keys, get_config
-from backend.helper.database import list_timeseries
 
 
 def get_queue_list(redis_client, queue):
     return [item.decode('utf-8') for item in redis_client.lrange(queue, 0, -1)]
 
 
-def get_bucket_status(redis_client, bucket):
+# a task keeps its last status until the bucket is reset
+FINISHED_STATUS = ["Done", "error"]
+
+
+def task_status_key(item: str, worker_id: str):
+    # tasks of one bucket can run at the same time on different workers, each of them reports on its own key
+    redis_keys = get_redis_keys()
+    task_hash = hashlib.sha1(item.encode("utf-8")).hexdigest()[:12]
+    return f"{redis_keys['ANOMALY_CALC_STATUS']}:{decode_task(item)['BID']}:{worker_id}:{task_hash}"
+
+
+def get_task_statuses(redis_client, bucket):
     redis_keys = get_redis_keys()
-    r_key = f"{redis_keys['ANOMALY_CALC_STATUS']}:{bucket}"
-    if not redis_client.exists(r_key):
+    prefix = f"{redis_keys['ANOMALY_CALC_STATUS']}:{bucket}:"
+    alive_workers = get_alive_workers(redis_client)
+    statuses = {}
+    for key in redis_client.scan_iter(f"{prefix}*"):
+        status = redis_client.get(key)
+        if status is None:
+            continue
+        status = json.loads(status)
+        worker_id = key.decode().replace(prefix, "").rsplit(":", 1)[0]
+        # a worker that died mid-task leaves its running status behind, the task itself is re-queued and reports anew
+        if status["message"] not in FINISHED_STATUS and worker_id not in alive_workers:
+            redis_client.delete(key)
+            continue
+        statuses[key.decode().replace(prefix, "")] = status
+    return statuses
+
+
+def get_bucket_status(redis_client, bucket):
+    # progress is summed over the tasks of the bucket, it is running while any task runs and errored if any task failed
+    statuses = list(get_task_statuses(redis_client, bucket).values())
+    if len(statuses) == 0:
         return {"message": "idle", "current": 0, "total": 0}
-    return json.loads(redis_client.get(r_key))
+    status = {key: sum(s.get(key, 0) for s in statuses) for key in ["current", "total"]}
+    for key in ["computed", "skipped"]:
+        if any(key in s for s in statuses):
+            status[key] = sum(s.get(key, 0) for s in statuses)
+    running = [s for s in statuses if s["message"] not in FINISHED_STATUS]
+    errors = [s for s in statuses if s["message"] == "error"]
+    if len(running) > 0:
+        status["message"] = running[0]["message"]
+    elif len(errors) > 0:
+        status["message"] = "error"
+        status["error"] = "\n".join(s["error"] for s in errors)
+    else:
+        status["message"] = "Done"
+    return status
+
+
+def clear_worker_statuses(redis_client, worker_id: str):
+    # running statuses of a previous process with the same worker id, its tasks were re-queued
+    redis_keys = get_redis_keys()
+    prefix = f"{redis_keys['ANOMALY_CALC_STATUS']}:"
+    for key in redis_client.scan_iter(f"{prefix}*:{worker_id}:*"):
+        status = redis_client.get(key)
+        if status is not None and json.loads(status)["message"] not in FINISHED_STATUS:
+            redis_client.delete(key)
+
+
+def clear_bucket_status(redis_client, bucket):
+    redis_keys = get_redis_keys()
+    redis_client.delete(f"{redis_keys['ANOMALY_CALC_STATUS']}:{bucket}")
+    for key in redis_client.scan_iter(f"{redis_keys['ANOMALY_CALC_STATUS']}:{bucket}:*"):
+        redis_client.delete(key)
 
 
 def get_currently_executing(redis_client, channel):
@@ -29,22 +90,89 @@ def clear_currently_executing(redis_client, channel):
         redis_client.delete(key)
 
 
+def encode_task(BID: str, TID: str = None, AlgoID: str = None, channel: str = None, append: bool = False):
+    task = {"BID": BID, "TID": TID, "AlgoID": AlgoID, "channel": channel, "append": append}
+    return json.dumps({k: v for k, v in task.items() if v is not None and v is not False}, sort_keys=True)
+
+
+def decode_task(item: str):
+    # items enqueued before tasks were introduced only consist of the bucket id
+    if not item.startswith("{"):
+        return {"BID": item, "TID": None, "AlgoID": None, "channel": None, "append": False}
+    return {"TID": None, "AlgoID": None, "channel": None, "append": False, **json.loads(item)}
+
+
+def get_queued_buckets(redis_client):
+    redis_keys = get_redis_keys()
+    buckets = [decode_task(item)["BID"] for item in get_queue_list(redis_client, redis_keys["ANOMALY_CALC_QUEUE"])]
+    return list(dict.fromkeys(buckets))
+
+
+def enqueue_task(redis_client, BID: str, TID: str = None, AlgoID: str = None, channel: str = None,
+                 append: bool = False):
+    redis_keys = get_redis_keys()
+    item = encode_task(BID, TID, AlgoID, channel, append)
+    queued = get_queue_list(redis_client, redis_keys["ANOMALY_CALC_QUEUE"])
+    # a pending run of the whole bucket already covers every task of this bucket. A running task is no reason to skip,
+    # it read its configuration and data before this change arrived.
+    if item in queued or encode_task(BID) in queued:
+        return False
+    redis_client.rpush(redis_keys["ANOMALY_CALC_QUEUE"], item)
+    return True
+
+
 def enqueue_bucket(redis_client, bid):
+    if get_bucket_status(redis_client, bid)["message"] == "idle":
+        enqueue_task(redis_client, bid)
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_item(redis_client, worker_id: str, timeout: float):
+    # the item stays in the worker's processing list until it is acknowledged, so a crash cannot lose it
+    redis_keys = get_redis_keys()
+    item = redis_client.blmove(redis_keys["ANOMALY_CALC_QUEUE"], f"{redis_keys['ANOMALY_CALC_PROCESSING']}:{worker_id}",
+                               timeout, "LEFT", "RIGHT")
+    return item.decode('utf-8') if item is not None else None
+
+
+def acknowledge_item(redis_client, worker_id: str, item: str):
     redis_keys = get_redis_keys()
-    if (bid not in get_queue_list(redis_client, redis_keys["ANOMALY_CALC_QUEUE"])
-            and bid not in get_currently_executing(redis_client, redis_keys["ANOMALY_CALC_STATUS"])):
-        redis_client.rpush(redis_keys["ANOMALY_CALC_QUEUE"], bid)
+    redis_client.lrem(f"{redis_keys['ANOMALY_CALC_PROCESSING']}:{worker_id}", 0, item)
 
 
-def filter_processing_dict(db: Database, bucket: str, proc_dict):
-    ts_list = [str(ts["_id"]) for ts in list_timeseries(db, ObjectId(bucket))]
-    result = {}
-    for ts in ts_list:
-        if ts in proc_dict:
-            result[ts] = proc_dict[ts]
-    if bucket in proc_dict:
-        result[bucket] = proc_dict[bucket]
-    return result
+def send_heartbeat(redis_client, worker_id: str, timeout: float):
+    redis_keys = get_redis_keys()
+    redis_client.set(f"{redis_keys['ANOMALY_CALC_WORKERS']}:{worker_id}", datetime.now().isoformat(), ex=int(timeout))
+
+
+def get_alive_workers(redis_client):
+    redis_keys = get_redis_keys()
+    return [key.decode().replace(f"{redis_keys['ANOMALY_CALC_WORKERS']}:", "")
+            for key in redis_client.scan_iter(f"{redis_keys['ANOMALY_CALC_WORKERS']}:*")]
+
+
+def requeue_worker_items(redis_client, worker_id: str):
+    redis_keys = get_redis_keys()
+    processing_key = f"{redis_keys['ANOMALY_CALC_PROCESSING']}:{worker_id}"
+    requeued = []
+    while (item := redis_client.lmove(processing_key, redis_keys["ANOMALY_CALC_QUEUE"], "RIGHT", "LEFT")) is not None:
+        requeued.append(item.decode('utf-8'))
+    return requeued
+
+
+def requeue_orphaned_items(redis_client):
+    redis_keys = get_redis_keys()
+    alive_workers = get_alive_workers(redis_client)
+    requeued = []
+    for key in redis_client.scan_iter(f"{redis_keys['ANOMALY_CALC_PROCESSING']}:*"):
+        worker_id = key.decode().replace(f"{redis_keys['ANOMALY_CALC_PROCESSING']}:", "")
+        # the heartbeat of this worker expired, hand its items back to the head of the queue
+        if worker_id not in alive_workers:
+            requeued.extend(requeue_worker_items(redis_client, worker_id))
+    return requeued
 
 
 if __name__ == '__main__':
@@ -0,0 +1,327 @@
+import datetime
+
+import bson
+import numpy as np
+from bson import ObjectId
+from pymongo import ReplaceOne
+from pymongo.database import Database
+
+import backend.helper.database as database
+import backend.helper.lod as lod
+from backend.helper.config import get_config
+
+conf = get_config()
+WRITE_BATCH_SIZE = 50000
+CHUNK_SIZE = conf["score_storage"]["chunk_size"]
+# "documents" stores one anomalyScores document per point, "chunked" stores CHUNK_SIZE consecutive scores of a series
+# as little endian float32 values and int64 millisecond timestamps in one scoreChunks document, together with the
+# time range and the extremes of the chunk. Buckets without a score_storage field predate the chunked format.
+STORAGE_FORMATS = ["documents", "chunked"]
+# aggregations bin_scores can reduce the scores of a time bin with
+BIN_ACCUMULATORS = ["$avg", "$max"]
+
+
+def get_storage(db: Database, BID: ObjectId):
+    # the bucket document is cached for the request or job, reads of many series only look it up once
+    bucket = database.get_bucket(db, BID)
+    return bucket.get("score_storage", "documents") if bucket is not None else "documents"
+
+
+def set_storage(db: Database, BID: ObjectId, storage: str):
+    db["buckets"].update_one({"_id": BID}, {"$set": {"score_storage": storage}})
+    database.invalidate_metadata()
+
+
+def document_filter(query: dict):
+    # score documents keep their ids in the meta field of the time series collection
+    return {key if key == "channel" else f"ids.{key}": value for key, value in query.items()}
+
+
+def to_milliseconds(timestamp: datetime.datetime):
+    return int(np.datetime64(lod.naive_utc(timestamp), "ms").astype(np.int64))
+
+
+def window_filter(field_from: str, field_to: str, from_: datetime.datetime = None, to_: datetime.datetime = None):
+    query = {}
+    if from_ is not None:
+        query[field_from] = {"$gte": from_}
+    if to_ is not None:
+        query[field_to] = {**query.get(field_to, {}), "$lte": to_}
+    return query
+
+
+def encode_chunk(milliseconds: np.ndarray, values: np.ndarray):
+    return {
+        "start": milliseconds[:1].astype("datetime64[ms]").item(),
+        "end": milliseconds[-1:].astype("datetime64[ms]").item(),
+        "count": len(values),
+        "min": float(np.min(values)),
+        "max": float(np.max(values)),
+        "timestamps": bson.Binary(milliseconds.astype("<i8").tobytes()),
+        "values": bson.Binary(values.astype("<f4").tobytes()),
+    }
+
+
+def decode_chunk(document: dict):
+    milliseconds = np.frombuffer(document["timestamps"], dtype="<i8").astype(np.int64)
+    return milliseconds, np.frombuffer(document["values"], dtype="<f4").astype(np.float64)
+
+
+# ----------------------------------------------
+#              Per point documents
+# ----------------------------------------------
+
+def write_documents(db: Database, BID: ObjectId, TID: ObjectId, AlgoID: ObjectId, channel: str, timestamps: list,
+                    scores: np.ndarray):
+    # documents are generated lazily and sent in unordered batches, so only one batch is materialized at a time
+    ids = {"BID": BID, "TID": TID, "AlgoID": AlgoID}
+    scores = np.asarray(scores, dtype=np.float64).tolist()
+    for start in range(0, len(scores), WRITE_BATCH_SIZE):
+        db["anomalyScores"].insert_many(
+            ({"timestamp": timestamp, "value": value, "ids": ids, "channel": channel}
+             for timestamp, value in zip(timestamps[start:start + WRITE_BATCH_SIZE],
+                                         scores[start:start + WRITE_BATCH_SIZE])),
+            ordered=False
+        )
+
+
+def read_documents(db: Database, TID: ObjectId, AlgoID: ObjectId, channel: str):
+    cursor = db["anomalyScores"].find_raw_batches({"ids.AlgoID": AlgoID, "ids.TID": TID, "channel": channel},
+                                                  {"_id": 0, "timestamp": 1, "value": 1}, sort=[("timestamp", 1)])
+    timestamps = []
+    chunks = []
+    for batch in cursor:
+        documents = bson.decode_all(batch)
+        timestamps.extend(document["timestamp"] for document in documents)
+        chunks.append(np.fromiter((document["value"] for document in documents), dtype=np.float64,
+                                  count=len(documents)))
+    return timestamps, np.concatenate(chunks) if chunks else np.empty(0)
+
+
+def scan_documents(db: Database, match: dict):
+    pipeline = [
+        {"$match": match},
+        {"$project": {"_id": 0, "timestamp": 1, "value": 1, "TID": "$ids.TID", "AlgoID": "$ids.AlgoID"}}
+    ]
+    for batch in db["anomalyScores"].aggregate_raw_batches(pipeline):
+        series = {}
+        for document in bson.decode_all(batch):
+            series.setdefault((document["TID"], document["AlgoID"]), []).append(document)
+        for (TID, AlgoID), documents in series.items():
+            timestamps = np.array([d["timestamp"] for d in documents], dtype="datetime64[ms]")
+            values = np.fromiter((d["value"] for d in documents), dtype=np.float64, count=len(documents))
+            yield TID, AlgoID, timestamps, values
+
+
+# ----------------------------------------------
+#              Chunked arrays
+# ----------------------------------------------
+
+def write_chunks(db: Database, BID: ObjectId, TID: ObjectId, AlgoID: ObjectId, channel: str, timestamps: list,
+                 scores: np.ndarray):
+    # scores are appended after the last chunk of the series, a partially filled last chunk is topped up first
+    key = {"TID": TID, "AlgoID": AlgoID, "channel": channel}
+    milliseconds = np.array(timestamps, dtype="datetime64[ms]").astype(np.int64)
+    values = np.asarray(scores, dtype=np.float32)
+    first_chunk = 0
+    last = db["scoreChunks"].find_one(key, sort=[("chunk", -1)])
+    if last is not None and last["count"] < CHUNK_SIZE:
+        last_milliseconds, last_values = decode_chunk(last)
+        milliseconds = np.concatenate([last_milliseconds, milliseconds])
+        values = np.concatenate([last_values.astype(np.float32), values])
+        first_chunk = last["chunk"]
+    elif last is not None:
+        first_chunk = last["chunk"] + 1
+    operations = []
+    for offset in range(0, len(values), CHUNK_SIZE):
+        chunk = first_chunk + offset // CHUNK_SIZE
+        document = {**key, "BID": BID, "chunk": chunk,
+                    **encode_chunk(milliseconds[offset:offset + CHUNK_SIZE], values[offset:offset + CHUNK_SIZE])}
+        operations.append(ReplaceOne({**key, "chunk": chunk}, document, upsert=True))
+    if len(operations) > 0:
+        db["scoreChunks"].bulk_write(operations, ordered=False)
+
+
+def delete_chunks(db: Database, TID: ObjectId, AlgoID: ObjectId, channel: str, after=None):
+    key = {"TID": TID, "AlgoID": AlgoID, "channel": channel}
+    query = {**key, "start": {"$gt": after}} if after is not None else key
+    deleted = sum(document["count"] for document in db["scoreChunks"].find(query, {"count": 1}))
+    db["scoreChunks"].delete_many(query)
+    if after is None:
+        return deleted
+    # the chunk that contains the cut is shortened to the scores up to and including after
+    straddling = db["scoreChunks"].find_one({**key, "start": {"$lte": after}, "end": {"$gt": after}})
+    if straddling is not None:
+        milliseconds, values = decode_chunk(straddling)
+        keep = milliseconds <= to_milliseconds(after)
+        deleted += int(np.count_nonzero(~keep))
+        db["scoreChunks"].update_one({"_id": straddling["_id"]},
+                                     {"$set": encode_chunk(milliseconds[keep], values[keep])})
+    return deleted
+
+
+def read_chunks(db: Database, TID: ObjectId, AlgoID: ObjectId, channel: str):
+    milliseconds = []
+    values = []
+    for document in db["scoreChunks"].find({"TID": TID, "AlgoID": AlgoID, "channel": channel}).sort("chunk", 1):
+        chunk_milliseconds, chunk_values = decode_chunk(document)
+        milliseconds.append(chunk_milliseconds)
+        values.append(chunk_values)
+    if len(values) == 0:
+        return [], np.empty(0)
+    return np.concatenate(milliseconds).astype("datetime64[ms]").tolist(), np.concatenate(values)
+
+
+def scan_chunks(db: Database, query: dict, from_: datetime.datetime = None, to_: datetime.datetime = None):
+    # chunks overlapping the window are read whole, the points outside of it are masked afterwards
+    cursor = db["scoreChunks"].find({**query, **window_filter("end", "start", from_, to_)},
+                                    {"TID": 1, "AlgoID": 1, "timestamps": 1, "values": 1})
+    for document in cursor:
+        milliseconds, values = decode_chunk(document)
+        mask = np.ones(len(values), dtype=bool)
+        if from_ is not None:
+            mask &= milliseconds >= to_milliseconds(from_)
+        if to_ is not None:
+            mask &= milliseconds <= to_milliseconds(to_)
+        yield document["TID"], document["AlgoID"], milliseconds[mask].astype("datetime64[ms]"), values[mask]
+
+
+# ----------------------------------------------
+#              Storage independent access
+# ----------------------------------------------
+
+def write_scores(db: Database, BID: ObjectId, TID: ObjectId, AlgoID: ObjectId, channel: str, timestamps: list,
+                 scores: np.ndarray):
+    # returns the scores as they are stored, chunked buckets keep them in single precision
+    if get_storage(db, BID) == "chunked":
+        write_chunks(db, BID, TID, AlgoID, channel, timestamps, scores)
+        return np.asarray(scores, dtype=np.float32).astype(np.float64)
+    write_documents(db, BID, TID, AlgoID, channel, timestamps, scores)
+    return np.asarray(scores, dtype=np.float64)
+
+
+def delete_scores(db: Database, TID: ObjectId, AlgoID: ObjectId, channel: str, after=None):
+    # both formats are cleared, a bucket may still hold leftovers of the format it was migrated from
+    query = {"ids.AlgoID": AlgoID, "ids.TID": TID, "channel": channel}
+    if after is not None:
+        query["timestamp"] = {"$gt": after}
+    deleted = db["anomalyScores"].delete_many(query).deleted_count
+    return deleted + delete_chunks(db, TID, AlgoID, channel, after)
+
+
+def delete_all_scores(db: Database, query: dict):
+    # query selects by BID, TID and/or AlgoID
+    db["anomalyScores"].delete_many(document_filter(query))
+    db["scoreChunks"].delete_many(query)
+
+
+def read_scores(db: Database, BID: ObjectId, TID: ObjectId, AlgoID: ObjectId, channel: str):
+    if get_storage(db, BID) == "chunked":
+        return read_chunks(db, TID, AlgoID, channel)
+    return read_documents(db, TID, AlgoID, channel)
+
+
+def scan_scores(db: Database, BID: ObjectId, TIDs: list, channel: str, AlgoIDs: list = None,
+                from_: datetime.datetime = None, to_: datetime.datetime = None):
+    # yields (TID, AlgoID, timestamps, values) for pieces of the selected series, pieces are not ordered
+    query = {"TID": {"$in": TIDs}, "channel": channel}
+    if AlgoIDs is not None:
+        query["AlgoID"] = {"$in": AlgoIDs}
+    if get_storage(db, BID) == "chunked":
+        yield from scan_chunks(db, query, from_, to_)
+    else:
+        yield from scan_documents(db, {**document_filter(query), **window_filter("timestamp", "timestamp", from_, to_)})
+
+
+def has_scores(db: Database, BID: ObjectId, query: dict = None):
+    query = {"BID": BID, **(query or {})}
+    if get_storage(db, BID) == "chunked":
+        return db["scoreChunks"].find_one(query, {"_id": 1}) is not None
+    return db["anomalyScores"].find_one(document_filter(query), {"_id": 1}) is not None
+
+
+def aggregate_stats(db: Database, BID: ObjectId, query: dict = None):
+    # min/max per series, channel and algorithm, chunks only need to combine their precomputed extremes
+    query = {"BID": BID, **(query or {})}
+    if get_storage(db, BID) == "chunked":
+        collection, match, prefix, min_field, max_field = "scoreChunks", query, "$", "$min", "$max"
+    else:
+        collection, match, prefix = "anomalyScores", document_filter(query), "$ids."
+        min_field = max_field = "$value"
+    pipeline = [
+        {"$match": match},
+        {
+            "$group": {
+                "_id": {"TID": f"{prefix}TID", "channel": "$channel", "algorithm": f"{prefix}AlgoID"},
+                "BID": {"$first": f"{prefix}BID"},
+                "minScore": {"$min": min_field},
+                "maxScore": {"$max": max_field}
+            }
+        }
+    ]
+    return list(db[collection].aggregate(pipeline))
+
+
+def bin_scores(db: Database, BID: ObjectId, TID: ObjectId, channel: str, AlgoIDs: list, from_: datetime.datetime,
+               to_: datetime.datetime, start: datetime.datetime, bin_size: int, accumulator: str = "$avg"):
+    # mean ("$avg") or highest ("$max") score per algorithm in bins of bin_size milliseconds counted from start,
+    # returns {AlgoID: (bins, values)}
+    if accumulator not in BIN_ACCUMULATORS:
+        raise ValueError(f"accumulator must be one of {', '.join(BIN_ACCUMULATORS)}")
+    if get_storage(db, BID) == "documents":
+        time_bin = {"$floor": {"$divide": [{"$subtract": ["$timestamp", start]}, bin_size]}}
+        match = {**document_filter({"TID": TID, "channel": channel, "AlgoID": {"$in": AlgoIDs}}),
+                 **window_filter("timestamp", "timestamp", from_, to_)}
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": {"algo": "$ids.AlgoID", "bin": time_bin}, "value": {accumulator: "$value"}}},
+            {"$sort": {"_id.bin": 1}}
+        ]
+        binned = {AlgoID: ([], []) for AlgoID in AlgoIDs}
+        for b in db["anomalyScores"].aggregate(pipeline):
+            binned[b["_id"]["algo"]][0].append(b["_id"]["bin"])
+            binned[b["_id"]["algo"]][1].append(b["value"])
+        return {AlgoID: (np.array(bins, dtype=np.float64), np.array(values, dtype=np.float64))
+                for AlgoID, (bins, values) in binned.items()}
+    # chunks hold their points as binary arrays the pipeline cannot unpack, their points are binned after decoding
+    pieces = {AlgoID: ([], []) for AlgoID in AlgoIDs}
+    origin = to_milliseconds(start)
+    for _, AlgoID, timestamps, values in scan_chunks(db, {"TID": TID, "channel": channel, "AlgoID": {"$in": AlgoIDs}},
+                                                     from_, to_):
+        pieces[AlgoID][0].append((timestamps.astype(np.int64) - origin) // bin_size)
+        pieces[AlgoID][1].append(values)
+    binned = {}
+    for AlgoID, (bins, values) in pieces.items():
+        if len(bins) == 0:
+            binned[AlgoID] = (np.empty(0), np.empty(0))
+            continue
+        bins, inverse = np.unique(np.concatenate(bins), return_inverse=True)
+        if accumulator == "$max":
+            reduced = np.full(len(bins), -np.inf)
+            np.maximum.at(reduced, inverse, np.concatenate(values))
+        else:
+            reduced = np.bincount(inverse, weights=np.concatenate(values)) / np.bincount(inverse)
+        binned[AlgoID] = (bins.astype(np.float64), reduced)
+    return binned
+
+
+def migrate_series(db: Database, BID: ObjectId, TID: ObjectId, AlgoID: ObjectId, channel: str, target: str):
+    # copies the scores of a series into the target format, the source is only cleared by finish_migration
+    if target == "chunked":
+        timestamps, values = read_documents(db, TID, AlgoID, channel)
+        db["scoreChunks"].delete_many({"TID": TID, "AlgoID": AlgoID, "channel": channel})
+        write_chunks(db, BID, TID, AlgoID, channel, timestamps, values)
+        return timestamps, values.astype(np.float32).astype(np.float64)
+    timestamps, values = read_chunks(db, TID, AlgoID, channel)
+    db["anomalyScores"].delete_many({"ids.TID": TID, "ids.AlgoID": AlgoID, "channel": channel})
+    write_documents(db, BID, TID, AlgoID, channel, timestamps, values)
+    return timestamps, values
+
+
+def finish_migration(db: Database, BID: ObjectId, target: str):
+    # readers follow the bucket's format, so the old copies are dropped only after the switch
+    set_storage(db, BID, target)
+    if target == "chunked":
+        db["anomalyScores"].delete_many({"ids.BID": BID})
+    else:
+        db["scoreChunks"].delete_many({"BID": BID})
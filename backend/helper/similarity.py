@@ -0,0 +1,118 @@
+import time
+from collections import OrderedDict
+
+import dtaidistance
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+from backend.helper.config import get_config
+
+conf = get_config()
+# anomalies are compared by their min-max scaled values, the index holds these resampled to a fixed length
+EMBEDDING_LENGTH = conf["similarity"]["embedding_length"]
+# nearest neighbours of the embedding that are compared with DTW
+CANDIDATES = conf["similarity"]["candidates"]
+# buckets whose shapes and indexes are kept, the least recently queried one is dropped first
+CACHED_BUCKETS = conf["similarity"]["cached_buckets"]
+# per bucket the scaled values and embedding per anomaly id, the window of an anomaly never changes
+shapes = OrderedDict()
+# per bucket the nearest neighbour index of every channel together with the anomaly ids it was built from
+indexes = OrderedDict()
+
+
+def normalize(values: np.ndarray):
+    values = np.asarray(values, dtype=np.double)
+    value_range = np.max(values) - np.min(values)
+    return (values - np.min(values)) / (value_range if value_range > 0 else 1)
+
+
+def embed(values: np.ndarray):
+    if len(values) == 1:
+        return np.repeat(values, EMBEDDING_LENGTH)
+    return np.interp(np.linspace(0, len(values) - 1, EMBEDDING_LENGTH), np.arange(len(values)), values)
+
+
+def bucket_shapes(BID):
+    # marks the bucket as recently used, the caches are pruned to CACHED_BUCKETS buckets
+    shapes.setdefault(BID, {})
+    indexes.setdefault(BID, {})
+    shapes.move_to_end(BID)
+    indexes.move_to_end(BID)
+    while len(shapes) > CACHED_BUCKETS:
+        drop_bucket(next(iter(shapes)))
+    return shapes[BID]
+
+
+def drop_bucket(BID):
+    shapes.pop(BID, None)
+    indexes.pop(BID, None)
+
+
+def add_shape(BID, AID, values: np.ndarray):
+    values = normalize(values)
+    bucket_shapes(BID)[AID] = (values, embed(values))
+
+
+def dtw_distance(first: np.ndarray, second: np.ndarray):
+    # absolute differences along the warping path, the measure fastdtw(dist=2) approximates
+    return dtaidistance.dtw.distance_fast(first, second, inner_dist="euclidean", use_pruning=False)
+
+
+def similar_length(first: int, second: int, length_tolerance: float):
+    return abs(first - second) / ((first + second) / 2) <= length_tolerance
+
+
+def nearest(BID, channel: str, AIDs: list, query: np.ndarray, k: int = CANDIDATES, length_tolerance: float = None,
+            exclude=None):
+    # every id needs a shape, the index is rebuilt whenever the ids of the bucket and channel change. An indexed query
+    # passes its own id as exclude and is skipped, leaving it out of AIDs would rebuild the index for every query.
+    if len(AIDs) == 0:
+        return []
+    bucket = bucket_shapes(BID)
+    ids, index = indexes[BID].get(channel, ((), None))
+    if ids != tuple(AIDs):
+        for AID in set(ids) - set(AIDs):
+            bucket.pop(AID, None)
+        index = NearestNeighbors().fit(np.array([bucket[AID][1] for AID in AIDs]))
+        indexes[BID][channel] = (tuple(AIDs), index)
+    embedding = embed(normalize(query)).reshape(1, -1)
+    # neighbours of a different length are skipped, the search widens until k of the right length are found
+    n_neighbors = k + 1 if exclude is not None else k
+    while True:
+        _, positions = index.kneighbors(embedding, n_neighbors=min(n_neighbors, len(AIDs)))
+        found = [
+            AIDs[position] for position in positions[0] if AIDs[position] != exclude and (
+                length_tolerance is None
+                or similar_length(len(bucket[AIDs[position]][0]), len(query), length_tolerance))
+        ]
+        if len(found) >= k or n_neighbors >= len(AIDs):
+            return found[:k]
+        n_neighbors *= 4
+
+
+def benchmark_similarity(sizes=(1000, 10000, 50000), queries=20):
+    # random walks with the length spread of extracted anomalies, DTW against everything vs the index
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        series = [np.cumsum(rng.normal(size=rng.integers(20, 200))) for _ in range(size)]
+        start = time.time()
+        for AID, values in enumerate(series):
+            add_shape("benchmark", AID, values)
+        nearest("benchmark", "value", list(range(size)), series[0])
+        print(f"{size} anomalies, embeddings and index: {time.time() - start:.2f}s")
+        start = time.time()
+        for query in series[:queries]:
+            query = normalize(query)
+            sorted(dtw_distance(query, shapes["benchmark"][AID][0]) for AID in range(size))
+        print(f"{size} anomalies, DTW against all: {(time.time() - start) / queries * 1000:.1f}ms per query")
+        start = time.time()
+        for query in series[:queries]:
+            candidates = nearest("benchmark", "value", list(range(size)), query)
+            query = normalize(query)
+            sorted(dtw_distance(query, shapes["benchmark"][AID][0]) for AID in candidates)
+        print(f"{size} anomalies, index and DTW re-ranking: {(time.time() - start) / queries * 1000:.1f}ms per query")
+        drop_bucket("benchmark")
+
+
+if __name__ == '__main__':
+    benchmark_similarity()
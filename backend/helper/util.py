@@ -83,8 +83,15 @@ def get_ts_labels(TID: ObjectId, channel: str, weights=None, only_manual: bool =
     return is_label, labels, ensemble_scores
 
 
-def add_dbr_pca_to_segments(BID: ObjectId, segments, normalize=True):
-    y = caching.get_dtw_matrix(str(BID), "segments")
+def segments_cache_key(db, BID: ObjectId, channel: str, resample_to_same_length=100, normalize=True):
+    # segments depend on the classification granularity of the bucket and on how they are resampled and scaled
+    bucket = database.get_bucket(db, BID)
+    granularity = f"{bucket['classification_granularity']}-{resample_to_same_length}-{normalize}"
+    return caching.cache_key(BID, "segments", channel, granularity)
+
+
+def add_dbr_pca_to_segments(BID: ObjectId, segments, key: str, normalize=True):
+    y = caching.get_dtw_matrix(key)
     if y is None:
         segment_values = [s["values"] for s in segments]
         if normalize:
@@ -96,7 +103,7 @@ def add_dbr_pca_to_segments(BID: ObjectId, segments, normalize=True):
 
         # y = dtaidistance.ed.distance_fast(segment_values)
         y = euclidean_distances(segment_values)
-        caching.store_dtw_matrix(str(BID), y, "segments")
+        y = caching.store_dtw_matrix(key, y)
 
     projected = PCA(n_components=2).fit_transform(y)
     projected = winsorize(projected, limits=[0.005, 0.005])
@@ -10,8 +10,10 @@ from modules.database import db_app
 from modules.anomalies import anomalies_app
 from modules.algoVis import algoVis_app
 import helper.database as database
+from helper.json_provider import JSONProvider
 
 app = flask.Flask(__name__)
+app.json = JSONProvider(app)
 app.config['SECRET_KEY'] = "hi mum"
 cors = CORS(app, supports_credentials=True)
 app.config['CORS_HEADERS'] = 'Content-Type'
@@ -0,0 +1,32 @@
+import argparse
+
+from bson import ObjectId
+
+import backend.helper.lod as lod
+import backend.helper.score_store as score_store
+from backend.helper.database import get_db, list_buckets, rebuild_score_baselines
+
+# converts the stored anomaly scores of buckets between one document per point and chunked float32 arrays, the
+# scheduler should be stopped meanwhile since scores written during the migration still use the old format
+parser = argparse.ArgumentParser()
+parser.add_argument("--to", choices=score_store.STORAGE_FORMATS, default="chunked", help="target storage format")
+parser.add_argument("--bucket", action="append", help="only migrate this bucket, can be given multiple times")
+args = parser.parse_args()
+
+db = get_db()
+for bucket in list_buckets(db):
+    if args.bucket is not None and bucket["_id"] not in [ObjectId(BID) for BID in args.bucket]:
+        continue
+    source = score_store.get_storage(db, bucket["_id"])
+    if source == args.to:
+        print(f"{bucket['name']} ({bucket['_id']}): already {args.to}")
+        continue
+    series = score_store.aggregate_stats(db, bucket["_id"])
+    for s in series:
+        TID, channel, AlgoID = s["_id"]["TID"], s["_id"]["channel"], s["_id"]["algorithm"]
+        timestamps, values = score_store.migrate_series(db, bucket["_id"], TID, AlgoID, channel, args.to)
+        # single precision changes the scores slightly, the score pyramid has to match what is stored
+        lod.build_pyramid(db, bucket["_id"], TID, channel, AlgoID, timestamps, values)
+    score_store.finish_migration(db, bucket["_id"], args.to)
+    rebuild_score_baselines(db, bucket["_id"])
+    print(f"{bucket['name']} ({bucket['_id']}): {len(series)} series migrated from {source} to {args.to}")
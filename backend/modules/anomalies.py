@@ -197,7 +197,8 @@ def flask_delete_nominal_by_date():
 
 @anomalies_app.get("cluster/<BID>")
 def flask_get_cluster(BID):
-    cache = caching.get_cluster_tree(BID, "CLUSTERING", "anomalies")
+    key = cluster.cache_key(BID)
+    cache = caching.get_cluster_tree(key)
     if cache is not None:
         return cache
 
@@ -205,7 +206,7 @@ def flask_get_cluster(BID):
     if not database.verify_id(db, BID, "buckets"):
         return "Bucket not found", 404
     hier_clust, json_tree = cluster.cluster(BID)
-    caching.store_cluster_tree(BID, json_tree, "anomalies")
+    caching.store_cluster_tree(key, json_tree)
     return json_tree
 
 
@@ -248,6 +249,19 @@ def flask_dissimilarities(BID):
     return database.dissimilar_recommender(db, ObjectId(BID), k, only_unrated)
 
 
+@anomalies_app.get("similar/<BID>/<AID>")
+def flask_similar_bookmarks(BID, AID):
+    db = flask.current_app.config["DB"]
+    if not database.verify_id(db, BID, "buckets"):
+        return "Bucket not found", 404
+    if not database.verify_id(db, AID, "anomalies"):
+        return "Anomaly not found", 404
+    max_distance = float(request.args.get('max_distance', 0.3))
+    length_tolerance = float(request.args.get('length_tolerance', 0.1))
+    similar = database.find_similar_bookmark(db, ObjectId(BID), ObjectId(AID), max_distance, length_tolerance)
+    return database.serialize_mongodb(similar)
+
+
 @anomalies_app.get("recommender/collab/<BID>")
 def flask_collab_recommender(BID):
     db = flask.current_app.config["DB"]
@@ -18,10 +18,18 @@ from tslearn.barycenters import softdtw_barycenter, euclidean_barycenter
 from tslearn.preprocessing import TimeSeriesResampler
 from werkzeug.utils import secure_filename
 import backend.helper.database as database
+import backend.helper.caching as caching
 import backend.helper.clustering as clustering
+import backend.helper.scheduler_queue as scheduler_queue
 from backend.helper.config import get_config
+from backend.helper.query import DOWNSAMPLING_MODES, RESPONSE_FORMATS, COLUMNAR_MIMETYPE
 
 db_app = flask.Blueprint("db", __name__)
+conf = get_config()
+redis_host = conf["scheduler"]["redis"]["host"]
+if os.environ.get('DOCKER', "False") == 'True':
+    redis_host = "anoscout_redis"
+r = redis.Redis(host=redis_host, port=conf["scheduler"]["redis"]["port"], db=1)
 
 ALLOWED_EXTENSIONS = {'csv', 'txt'}
 
@@ -79,6 +87,7 @@ def flask_update_bucket():
     threshold = json.loads(request.data).get("threshold", False)
     smoothing_window = json.loads(request.data).get("smoothing_window", False)
     classification_ensemble = json.loads(request.data).get("classification_ensemble", False)
+    shared_model = json.loads(request.data).get("shared_model", None)
 
     if name:
         database.rename_bucket(db, ObjectId(id_), name)
@@ -88,6 +97,8 @@ def flask_update_bucket():
         database.set_threshold(db, ObjectId(id_), threshold)
     if classification_ensemble:
         database.set_classification_ensemble(db, ObjectId(id_), classification_ensemble)
+    if shared_model is not None:
+        database.set_shared_model(db, ObjectId(id_), bool(shared_model))
 
     return {"success": True}
 
@@ -142,7 +153,11 @@ def flask_bucket_score_distribution(BID, channel):
 
 @db_app.get("bucket/<BID>/cluster/<channel>")
 def flask_cluster_bucket(BID, channel):
-    hier_clust, json_tree = clustering.cluster(ObjectId(BID), "timeseries", channel)
+    key = clustering.cache_key(BID, "timeseries", channel)
+    json_tree = caching.get_cluster_tree(key)
+    if json_tree is None:
+        hier_clust, json_tree = clustering.cluster(ObjectId(BID), "timeseries", channel)
+        caching.store_cluster_tree(key, json_tree)
     return database.serialize_mongodb(json_tree)
 
 
@@ -259,6 +274,25 @@ def flask_import_ts():
         return "Hi", 200
 
 
+@db_app.post("ts/append/<timeseries>")
+def flask_append_ts(timeseries):
+    db = flask.current_app.config["DB"]
+    if not database.verify_id(db, timeseries, "timeSeries"):
+        return "Timeseries not found", 404
+    items = json.loads(request.data)
+    if not isinstance(items, list) or len(items) == 0:
+        return "A non-empty list of data points is required", 400
+    try:
+        appended_from = database.append_timeseries(db, items, ObjectId(timeseries))
+    except ValueError as e:
+        return str(e), 400
+    if appended_from is None:
+        return {"success": True, "appended": False}
+    ts = database.get_timeseries(db, ObjectId(timeseries))
+    scheduler_queue.enqueue_task(r, str(ts["BID"]), TID=timeseries, append=True)
+    return {"success": True, "appended": True}
+
+
 @db_app.get("ts/channels/<timeseries>")
 def flask_channels(timeseries):
     db = flask.current_app.config["DB"]
@@ -285,7 +319,19 @@ def flask_query_timeseries(timeseries):
     n_segments = request.args.get("n_segments", None)
     if n_segments is not None:
         n_segments = int(n_segments)
-    data = database.query_timeseries(db, ObjectId(timeseries), from_=from_, to_=to, n_segments=n_segments, channel=channel)
+    downsampling = request.args.get("downsampling", None)
+    if downsampling is not None and downsampling not in DOWNSAMPLING_MODES:
+        return f"downsampling must be one of {', '.join(DOWNSAMPLING_MODES)}", 400
+    # the columnar format is requested explicitly or through the accept header
+    response_format = request.args.get("format", None)
+    if response_format is None:
+        accepted = request.accept_mimetypes.best_match(["application/json", COLUMNAR_MIMETYPE])
+        response_format = "columnar" if accepted == COLUMNAR_MIMETYPE else "rows"
+    if response_format not in RESPONSE_FORMATS:
+        return f"format must be one of {', '.join(RESPONSE_FORMATS)}", 400
+    data = database.query_timeseries(db, ObjectId(timeseries), from_=from_, to_=to, n_segments=n_segments,
+                                     channel=channel, downsampling=downsampling,
+                                     columnar=response_format == "columnar")
     return data
 
 
@@ -380,3 +426,8 @@ def flask_zoomlevel_timeseries(timeseries):
     from_ = parser.parse(from_) if from_ is not None else None
     to = parser.parse(to) if from_ is not None else None
     return flask.jsonify(database.calculate_zoom_level(db, ObjectId(timeseries), from_, to))
+
+
+@db_app.get("cache/metrics")
+def flask_cache_metrics():
+    return caching.cache_metrics()
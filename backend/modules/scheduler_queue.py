@@ -19,13 +19,12 @@ r = redis.Redis(host=redis_host, port=conf["scheduler"]["redis"]["port"], db=1)
 redis_keys = get_redis_keys()
 
 ANOMALY_CALC_QUEUE = redis_keys["ANOMALY_CALC_QUEUE"]
-ANOMALY_CALC_STATUS = redis_keys["ANOMALY_CALC_STATUS"]
 ANOMALY_CALC_ERRORED = redis_keys["ANOMALY_CALC_ERRORED"]
 
 
 @queue_app.get("/")
 def flask_get_queue():
-    return scheduler_queue.get_queue_list(r, ANOMALY_CALC_QUEUE)
+    return scheduler_queue.get_queued_buckets(r)
 
 
 @queue_app.post("enqueue/<bucket>")
@@ -37,6 +36,28 @@ def flask_enqueue_bucket(bucket):
     return {"success": True}
 
 
+@queue_app.post("enqueue/algorithm/<AlgoID>")
+def flask_enqueue_algorithm(AlgoID):
+    db = flask.current_app.config["DB"]
+    if not database.verify_id(db, AlgoID, "algorithms"):
+        return "Algorithm not found", 404
+    algo = database.get_algorithm(db, ObjectId(AlgoID))
+    channel = flask.request.args.get("channel", None)
+    enqueued = scheduler_queue.enqueue_task(r, str(algo["BID"]), AlgoID=AlgoID, channel=channel)
+    return {"success": True, "enqueued": enqueued}
+
+
+@queue_app.post("enqueue/ts/<TID>")
+def flask_enqueue_timeseries(TID):
+    db = flask.current_app.config["DB"]
+    if not database.verify_id(db, TID, "timeSeries"):
+        return "Timeseries not found", 404
+    ts = database.get_timeseries(db, ObjectId(TID))
+    channel = flask.request.args.get("channel", None)
+    enqueued = scheduler_queue.enqueue_task(r, str(ts["BID"]), TID=TID, channel=channel)
+    return {"success": True, "enqueued": enqueued}
+
+
 @queue_app.get("status/<bucket>")
 def flask_bucket_status(bucket):
     db = flask.current_app.config["DB"]
@@ -50,7 +71,7 @@ def flask_bucket_reset_status(bucket):
     db = flask.current_app.config["DB"]
     if not database.verify_id(db, bucket, "buckets"):
         return "Bucket not found", 404
-    r.delete(f"{ANOMALY_CALC_STATUS}:{bucket}")
+    scheduler_queue.clear_bucket_status(r, bucket)
     r.delete(f"{ANOMALY_CALC_ERRORED}:{bucket}")
     return {"success": True}
 
@@ -60,9 +81,8 @@ def flask_queue_errored(bucket):
     db = flask.current_app.config["DB"]
     if not database.verify_id(db, bucket, "buckets"):
         return "Bucket not found", 404
-    proc_dict = {
-        **scheduler_queue.get_currently_executing(r, ANOMALY_CALC_ERRORED)
-    }
-    db = flask.current_app.config["DB"]
-    return scheduler_queue.filter_processing_dict(db, bucket, proc_dict)
+    errored = scheduler_queue.get_currently_executing(r, ANOMALY_CALC_ERRORED)
+    # errors are keyed by the bucket or by one of its timeseries
+    ids = [str(ts["_id"]) for ts in database.list_timeseries(db, ObjectId(bucket))] + [bucket]
+    return {key: errored[key] for key in ids if key in errored}
 
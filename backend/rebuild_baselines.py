@@ -0,0 +1,19 @@
+import argparse
+
+from backend.helper.database import get_db, list_buckets, rebuild_score_baselines, verify_score_baselines
+
+# checks the materialized score baselines of every bucket against the stored scores and rebuilds the ones that drifted
+parser = argparse.ArgumentParser()
+parser.add_argument("--verify-only", action="store_true", help="only report buckets whose baseline is inconsistent")
+parser.add_argument("--force", action="store_true", help="rebuild every bucket, even consistent ones")
+args = parser.parse_args()
+
+db = get_db()
+for bucket in list_buckets(db):
+    mismatches = verify_score_baselines(db, bucket["_id"])
+    print(f"{bucket['name']} ({bucket['_id']}): {len(mismatches)} inconsistent baselines")
+    for channel, AlgoID in mismatches:
+        print(f"    channel {channel}, algorithm {AlgoID}")
+    if not args.verify_only and (args.force or len(mismatches) > 0):
+        rebuild_score_baselines(db, bucket["_id"])
+        print("    rebuilt")
@@ -0,0 +1,24 @@
+import unittest
+
+import numpy as np
+import stumpy
+
+from backend.anomaly_detection.MatrixProfile import IncrementalMatrixProfile
+
+
+class IncrementalMatrixProfileTest(unittest.TestCase):
+    def test_update_matches_stump_with_flat_segments(self):
+        m = 20
+        for seed in range(4):
+            rng = np.random.default_rng(seed)
+            T = np.cumsum(rng.normal(size=600))
+            T[200:300] = T[200]
+            T[450:470] = 3.0
+            profile = IncrementalMatrixProfile(T[:400], m)
+            profile.update(T[400:])
+            np.testing.assert_allclose(profile.P, stumpy.stump(T, m)[:, 0].astype(float), atol=1e-5,
+                                       err_msg=f"seed {seed}")
+
+
+if __name__ == '__main__':
+    unittest.main()
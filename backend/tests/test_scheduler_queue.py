@@ -0,0 +1,141 @@
+import fnmatch
+import json
+import unittest
+from unittest import mock
+
+import flask
+from bson import ObjectId
+
+import backend.helper.scheduler_queue as scheduler_queue
+import backend.modules.scheduler_queue as scheduler_queue_module
+from backend.helper.config import get_redis_keys
+
+
+class FakeRedis:
+    # the few commands the queue endpoints use, keyed by str and returning bytes like redis-py
+    def __init__(self, values: dict):
+        self.values = {key: value.encode() for key, value in values.items()}
+
+    def scan_iter(self, pattern):
+        return [key.encode() for key in list(self.values) if fnmatch.fnmatchcase(key, pattern)]
+
+    def get(self, key):
+        return self.values.get(key.decode() if isinstance(key, bytes) else key)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key.decode() if isinstance(key, bytes) else key, None)
+
+    def lrange(self, key, start, end):
+        return list(self.values.get(key, []))
+
+    def rpush(self, key, *items):
+        self.values.setdefault(key, []).extend(item.encode() for item in items)
+
+    def blmove(self, source, destination, timeout, src, dest):
+        if len(self.values.get(source, [])) == 0:
+            return None
+        item = self.values[source].pop(0 if src == "LEFT" else -1)
+        self.values.setdefault(destination, []).append(item)
+        return item
+
+
+class ErroredEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.app = flask.Flask(__name__)
+        self.app.config["DB"] = None
+        self.app.register_blueprint(scheduler_queue_module.queue_app, url_prefix="/api/queue")
+
+    def test_errored_returns_errors_of_the_bucket_and_its_timeseries(self):
+        BID, TID, other = ObjectId(), ObjectId(), ObjectId()
+        errored = get_redis_keys()["ANOMALY_CALC_ERRORED"]
+        fake = FakeRedis({
+            f"{errored}:{BID}": json.dumps({"error": "bucket"}),
+            f"{errored}:{TID}": json.dumps({"error": "timeseries"}),
+            f"{errored}:{other}": json.dumps({"error": "other bucket"}),
+        })
+        with mock.patch.object(scheduler_queue_module, "r", fake), \
+                mock.patch.object(scheduler_queue_module.database, "verify_id", return_value=True), \
+                mock.patch.object(scheduler_queue_module.database, "list_timeseries", return_value=[{"_id": TID}]):
+            response = self.app.test_client().get(f"/api/queue/errored/{BID}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {str(BID): {"error": "bucket"}, str(TID): {"error": "timeseries"}})
+
+    def test_errored_unknown_bucket(self):
+        with mock.patch.object(scheduler_queue_module.database, "verify_id", return_value=False):
+            response = self.app.test_client().get(f"/api/queue/errored/{ObjectId()}")
+        self.assertEqual(response.status_code, 404)
+
+
+class EnqueueTaskTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeRedis({})
+        self.BID = str(ObjectId())
+        self.TID = str(ObjectId())
+        self.queue = get_redis_keys()["ANOMALY_CALC_QUEUE"]
+
+    def test_duplicate_of_a_pending_task_is_skipped(self):
+        self.assertTrue(scheduler_queue.enqueue_task(self.fake, self.BID, TID=self.TID))
+        self.assertFalse(scheduler_queue.enqueue_task(self.fake, self.BID, TID=self.TID))
+        self.assertEqual(len(scheduler_queue.get_queue_list(self.fake, self.queue)), 1)
+
+    def test_pending_bucket_run_covers_its_tasks(self):
+        scheduler_queue.enqueue_task(self.fake, self.BID)
+        self.assertFalse(scheduler_queue.enqueue_task(self.fake, self.BID, TID=self.TID))
+
+    def test_task_is_queued_again_while_it_runs(self):
+        scheduler_queue.enqueue_task(self.fake, self.BID, TID=self.TID)
+        item = scheduler_queue.claim_item(self.fake, "worker:1", 0)
+        self.assertTrue(scheduler_queue.enqueue_task(self.fake, self.BID, TID=self.TID))
+        self.assertEqual(scheduler_queue.get_queue_list(self.fake, self.queue), [item])
+
+    def test_append_is_queued_again_while_an_append_runs(self):
+        # points appended during the run are past the data that run read
+        scheduler_queue.enqueue_task(self.fake, self.BID, TID=self.TID, append=True)
+        item = scheduler_queue.claim_item(self.fake, "worker:1", 0)
+        self.assertTrue(scheduler_queue.decode_task(item)["append"])
+        self.assertTrue(scheduler_queue.enqueue_task(self.fake, self.BID, TID=self.TID, append=True))
+        self.assertEqual(scheduler_queue.get_queue_list(self.fake, self.queue), [item])
+
+
+class BucketStatusTest(unittest.TestCase):
+    def status_of(self, *statuses, alive=True):
+        BID = str(ObjectId())
+        fake = FakeRedis({
+            scheduler_queue.task_status_key(scheduler_queue.encode_task(BID, TID=str(i)), "worker:1"): json.dumps(status)
+            for i, status in enumerate(statuses)
+        })
+        if alive:
+            fake.values[f"{get_redis_keys()['ANOMALY_CALC_WORKERS']}:worker:1"] = b"1"
+        return scheduler_queue.get_bucket_status(fake, BID)
+
+    def test_idle_without_tasks(self):
+        self.assertEqual(self.status_of(), {"message": "idle", "current": 0, "total": 0})
+
+    def test_running_while_any_task_runs(self):
+        status = self.status_of({"message": "Done", "current": 2, "total": 2},
+                                {"message": "ts algo", "current": 1, "total": 3})
+        self.assertEqual(status, {"message": "ts algo", "current": 3, "total": 5})
+
+    def test_error_is_not_masked_by_done(self):
+        status = self.status_of({"message": "Done", "current": 2, "total": 2},
+                                {"message": "error", "current": 0, "total": 0, "error": "failed"})
+        self.assertEqual(status["message"], "error")
+        self.assertEqual(status["error"], "failed")
+
+    def test_running_status_of_dead_worker_is_dropped(self):
+        status = self.status_of({"message": "ts algo", "current": 1, "total": 3}, alive=False)
+        self.assertEqual(status, {"message": "idle", "current": 0, "total": 0})
+
+    def test_finished_status_of_dead_worker_is_kept(self):
+        status = self.status_of({"message": "Done", "current": 2, "total": 2}, alive=False)
+        self.assertEqual(status, {"message": "Done", "current": 2, "total": 2})
+
+    def test_done_when_all_tasks_are_done(self):
+        status = self.status_of({"message": "Done", "current": 2, "total": 2, "computed": 1, "skipped": 1},
+                                {"message": "Done", "current": 1, "total": 1, "computed": 1, "skipped": 0})
+        self.assertEqual(status, {"message": "Done", "current": 3, "total": 3, "computed": 2, "skipped": 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
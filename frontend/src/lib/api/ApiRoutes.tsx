@@ -34,6 +34,7 @@ export const tsRoutes = {
   queryTs: new ApiRoute<undefined, { TID: string }, types.TimeSeriesQuery, types.TimeSeriesDataPoint[]>("GET", "/db/ts/query/:TID"),
   queryTsList: new ApiRoute<string[], { TID: string }, { channel: string; n_segments: number; BID: string }, types.TimeSeriesListData>("POST", "/db/ts/query/list"),
   queryTsListImage: new ApiRoute<string[], { TID: string }, { channel: string; n_segments: number }, types.TimeSeriesListData>("POST", "/db/ts/query/list/image"),
+  appendTs: new ApiRoute<{ [key: string]: string | number }[], { TID: string }, undefined, types.DefaultAppResponse>("POST", "/db/ts/append/:TID"),
   updateTs: new ApiRoute<types.TimeSeriesUpdate, undefined, undefined, types.DefaultAppResponse>("POST", "/db/ts/update"),
   deleteTs: new ApiRoute<{ id: string }, undefined, undefined, types.DefaultAppResponse>("DELETE", "/db/ts/delete"),
 };
@@ -41,6 +42,8 @@ export const tsRoutes = {
 export const queueRoutes = {
   queueStatus: new ApiRoute<undefined, undefined, undefined, string[]>("GET", "/queue"),
   enqueueBucket: new ApiRoute<undefined, { bucket: string }, undefined, types.DefaultAppResponse>("POST", "/queue/enqueue/:bucket"),
+  enqueueAlgorithm: new ApiRoute<undefined, { algoId: string }, { channel?: string }, types.DefaultAppResponse>("POST", "/queue/enqueue/algorithm/:algoId"),
+  enqueueTimeseries: new ApiRoute<undefined, { TID: string }, { channel?: string }, types.DefaultAppResponse>("POST", "/queue/enqueue/ts/:TID"),
   schedulerBucketStatus: new ApiRoute<undefined, { bucket: string }, undefined, types.SchedulerBucketStatus>("GET", "/queue/status/:bucket"),
   schedulerResetStatus: new ApiRoute<undefined, { bucket: string }, undefined, types.DefaultAppResponse>("POST", "/queue/reset/:bucket"),
 };
@@ -15,6 +15,8 @@ export type SchedulerBucketStatus = {
   message: string;
   current: number;
   total: number;
+  computed?: number;
+  skipped?: number;
   error?: string;
 };
 
@@ -68,6 +70,7 @@ export type Bucket = {
   type: "scoring" | "classification";
   classification_granularity: null | string;
   classification_ensemble: string;
+  shared_model?: boolean;
 };
 
 export type BucketUpdate = {
@@ -76,6 +79,7 @@ export type BucketUpdate = {
   smoothing_window?: number;
   threshold?: number;
   classification_ensemble?: string;
+  shared_model?: boolean;
 };
 
 export type Histogram = {